@@ -39,16 +39,27 @@ dictionary).
 
 To work with plist data in strings, you can use readPlistFromString()
 and writePlistToString().
+
+PyObjC is slow to import, so Foundation is only imported when a plist
+is first read or written. When it is not available (e.g. on Linux), a
+pure-Python backend is used instead. It reads XML plists incrementally
+with expat, reads binary plists, and writes XML plists.
+
+To stream the items of a plist whose root object is an array (like a
+Munki catalog), optionally keeping only some keys of each dict item,
+use iterPlistArray(filepath, keys).
 """
 
-# PyLint cannot properly find names inside Cocoa libraries, so issues bogus
-# No name 'Foo' in module 'Bar' warnings. Disable them.
-# pylint: disable=E0611
-from Foundation import NSData
-from Foundation import NSPropertyListSerialization
-from Foundation import NSPropertyListMutableContainers
-from Foundation import NSPropertyListXMLFormat_v1_0
-# pylint: enable=E0611
+import base64
+import datetime
+import os
+import plistlib
+import struct
+import tempfile
+from xml.parsers import expat
+
+# Whether Foundation is available; None until haveFoundation is called.
+HAVE_FOUNDATION = None
 
 # Disable PyLint complaining about 'invalid' camelCase names
 # pylint: disable=C0103
@@ -66,7 +77,63 @@ class NSPropertyListWriteException(FoundationPlistException):
     """Write error for plists"""
     pass
 
+
+def haveFoundation():
+    """Import Foundation on first use; return whether it's available."""
+    # PyLint cannot properly find names inside Cocoa libraries, so issues
+    # bogus No name 'Foo' in module 'Bar' warnings. Disable them.
+    # pylint: disable=E0611,W0603
+    global HAVE_FOUNDATION, NSData, NSPropertyListSerialization
+    global NSPropertyListMutableContainers, NSPropertyListXMLFormat_v1_0
+    if HAVE_FOUNDATION is None:
+        try:
+            from Foundation import NSData
+            from Foundation import NSPropertyListSerialization
+            from Foundation import NSPropertyListMutableContainers
+            from Foundation import NSPropertyListXMLFormat_v1_0
+            HAVE_FOUNDATION = True
+        except ImportError:
+            HAVE_FOUNDATION = False
+    # pylint: enable=E0611,W0603
+    return HAVE_FOUNDATION
+
+
 def readPlist(filepath):
+    """
+    Read a .plist file from filepath.  Return the unpacked root object
+    (which is usually a dictionary).
+    """
+    if haveFoundation():
+        return nsReadPlist(filepath)
+    return pyReadPlist(filepath)
+
+
+def readPlistFromString(data):
+    '''Read a plist data from a string. Return the root object.'''
+    if haveFoundation():
+        return nsReadPlistFromString(data)
+    return pyReadPlistFromString(data)
+
+
+def writePlist(dataObject, filepath):
+    '''
+    Write 'rootObject' as a plist to filepath.
+    '''
+    if haveFoundation():
+        return nsWritePlist(dataObject, filepath)
+    return pyWritePlist(dataObject, filepath)
+
+
+def writePlistToString(rootObject):
+    '''Return 'rootObject' as a plist-formatted string.'''
+    if haveFoundation():
+        return nsWritePlistToString(rootObject)
+    return pyWritePlistToString(rootObject)
+
+
+# Foundation backend.
+
+def nsReadPlist(filepath):
     """
     Read a .plist file from filepath.  Return the unpacked root object
     (which is usually a dictionary).
@@ -87,7 +154,7 @@ def readPlist(filepath):
         return dataObject
 
 
-def readPlistFromString(data):
+def nsReadPlistFromString(data):
     '''Read a plist data from a string. Return the root object.'''
     try:
         plistData = buffer(data)
@@ -107,7 +174,7 @@ def readPlistFromString(data):
         return dataObject
 
 
-def writePlist(dataObject, filepath):
+def nsWritePlist(dataObject, filepath):
     '''
     Write 'rootObject' as a plist to filepath.
     '''
@@ -129,7 +196,7 @@ def writePlist(dataObject, filepath):
                 "Failed to write plist data to %s" % filepath)
 
 
-def writePlistToString(rootObject):
+def nsWritePlistToString(rootObject):
     '''Return 'rootObject' as a plist-formatted string.'''
     plistData, error = (
         NSPropertyListSerialization.
@@ -145,3 +212,355 @@ def writePlistToString(rootObject):
         return str(plistData)
 
 
+# Pure-Python backend.
+
+BINARY_HEADER = "bplist00"
+READ_CHUNK_SIZE = 64 * 1024
+# Binary plist dates are seconds since 2001-01-01.
+APPLE_EPOCH = datetime.datetime(2001, 1, 1)
+
+
+def _compact_string(value):
+    """Return ASCII unicode as str, as plistlib does, to save memory."""
+    try:
+        return value.encode("ascii")
+    except UnicodeError:
+        return value
+
+
+class XMLPlistParser(object):
+    """Incremental, expat based XML plist parser.
+
+    Feed data in chunks with feed(), then call close() to get the root
+    object.
+
+    If item_callback is given and the root object is an array, each of
+    its items is passed to item_callback as soon as it is parsed rather
+    than being added to the root array. If item_keys is given, dict
+    items of a root array only keep those keys; the values of other
+    keys are skipped without being built.
+    """
+
+    def __init__(self, item_callback=None, item_keys=None):
+        self.item_callback = item_callback
+        self.item_keys = item_keys
+        # Depth of elements within a value that is being skipped.
+        self.skip_depth = 0
+        self.skip_next = False
+        self.parser = expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self.handle_start
+        self.parser.EndElementHandler = self.handle_end
+        self.parser.CharacterDataHandler = self.handle_data
+        self.stack = []
+        self.keys = []
+        self.data = []
+        self.root = None
+        self.have_root = False
+
+    def feed(self, data, final=False):
+        try:
+            self.parser.Parse(data, final)
+        except (expat.ExpatError, ValueError, TypeError) as err:
+            raise NSPropertyListSerializationException(err)
+
+    def close(self):
+        self.feed("", final=True)
+        if not self.have_root:
+            raise NSPropertyListSerializationException(
+                "No root object found")
+        return self.root
+
+    def handle_start(self, element, dummy_attrs):
+        if self.skip_depth:
+            self.skip_depth += 1
+            return
+        elif self.skip_next:
+            self.skip_next = False
+            self.skip_depth = 1
+            return
+        self.data = []
+        if element == "dict":
+            self.stack.append({})
+            self.keys.append(None)
+        elif element == "array":
+            self.stack.append([])
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.data.append(data)
+
+    def handle_end(self, element):
+        if self.skip_depth:
+            self.skip_depth -= 1
+            return
+        data = "".join(self.data)
+        self.data = []
+        if element == "key":
+            self.keys[-1] = _compact_string(data)
+            self.skip_next = (
+                self.item_keys is not None and self.in_root_array_item() and
+                self.keys[-1] not in self.item_keys)
+            return
+        elif element == "dict":
+            self.keys.pop()
+            value = self.stack.pop()
+        elif element == "array":
+            value = self.stack.pop()
+        elif element == "string":
+            value = _compact_string(data)
+        elif element == "integer":
+            value = int(data)
+        elif element == "real":
+            value = float(data)
+        elif element == "true":
+            value = True
+        elif element == "false":
+            value = False
+        elif element == "date":
+            value = datetime.datetime.strptime(data, "%Y-%m-%dT%H:%M:%SZ")
+        elif element == "data":
+            value = plistlib.Data(base64.b64decode(data))
+        else:
+            # <plist> and any unknown elements carry no value.
+            return
+        self.add_value(value)
+
+    def in_root_array_item(self):
+        return len(self.stack) == 2 and isinstance(self.stack[0], list)
+
+    def add_value(self, value):
+        if not self.stack:
+            self.root = value
+            self.have_root = True
+        elif (self.item_callback and len(self.stack) == 1 and
+              isinstance(self.stack[0], list)):
+            self.item_callback(value)
+        elif isinstance(self.stack[-1], dict):
+            self.stack[-1][self.keys[-1]] = value
+        else:
+            self.stack[-1].append(value)
+
+
+class BinaryPlistParser(object):
+    """Parser for 'bplist00' format binary plists."""
+
+    def __init__(self, data):
+        self.data = data
+        self.objects = {}
+
+    def parse(self):
+        if len(self.data) < 40 or not self.data.startswith(BINARY_HEADER):
+            raise NSPropertyListSerializationException(
+                "Not a binary plist")
+        (self.offset_size, self.ref_size, num_objects, top_object,
+         offset_table_offset) = struct.unpack(">6xBBQQQ", self.data[-32:])
+        self.offsets = [
+            self.read_int(offset_table_offset + index * self.offset_size,
+                          self.offset_size)
+            for index in xrange(num_objects)]
+        try:
+            return self.read_object(top_object)
+        except (IndexError, struct.error, UnicodeError) as err:
+            raise NSPropertyListSerializationException(err)
+
+    def read_int(self, offset, size):
+        if size == 16:
+            # 128 bit integers are only used for values that also fit
+            # in the low 64 bits.
+            offset, size = offset + 8, 8
+        fmt = {1: ">B", 2: ">H", 4: ">L", 8: ">q"}[size]
+        return struct.unpack(fmt, self.data[offset:offset + size])[0]
+
+    def read_count(self, offset, info):
+        """Return (count, offset of first element) for an object."""
+        if info != 0xF:
+            return info, offset + 1
+        int_size = 1 << (ord(self.data[offset + 1]) & 0xF)
+        count = self.read_int(offset + 2, int_size)
+        return count, offset + 2 + int_size
+
+    def read_refs(self, offset, count):
+        return [self.read_int(offset + index * self.ref_size, self.ref_size)
+                for index in xrange(count)]
+
+    def read_object(self, ref):
+        if ref in self.objects:
+            return self.objects[ref]
+
+        offset = self.offsets[ref]
+        marker = ord(self.data[offset])
+        kind, info = marker >> 4, marker & 0xF
+        if marker == 0x00:
+            value = None
+        elif marker == 0x08:
+            value = False
+        elif marker == 0x09:
+            value = True
+        elif kind == 0x1:
+            value = self.read_int(offset + 1, 1 << info)
+        elif kind == 0x2:
+            fmt = {2: ">f", 3: ">d"}[info]
+            value = struct.unpack(
+                fmt, self.data[offset + 1:offset + 1 + (1 << info)])[0]
+        elif marker == 0x33:
+            seconds = struct.unpack(">d", self.data[offset + 1:offset + 9])[0]
+            value = APPLE_EPOCH + datetime.timedelta(seconds=seconds)
+        elif kind == 0x4:
+            count, start = self.read_count(offset, info)
+            value = plistlib.Data(self.data[start:start + count])
+        elif kind == 0x5:
+            count, start = self.read_count(offset, info)
+            value = self.data[start:start + count]
+        elif kind == 0x6:
+            count, start = self.read_count(offset, info)
+            value = _compact_string(
+                self.data[start:start + count * 2].decode("utf-16be"))
+        elif kind == 0x8:
+            value = self.read_int(offset + 1, info + 1)
+        elif kind == 0xA:
+            count, start = self.read_count(offset, info)
+            value = [self.read_object(item_ref)
+                     for item_ref in self.read_refs(start, count)]
+        elif kind == 0xD:
+            count, start = self.read_count(offset, info)
+            key_refs = self.read_refs(start, count)
+            value_refs = self.read_refs(start + count * self.ref_size, count)
+            value = {self.read_object(key_ref): self.read_object(value_ref)
+                     for key_ref, value_ref in zip(key_refs, value_refs)}
+        else:
+            raise NSPropertyListSerializationException(
+                "Unknown binary plist object type 0x%02x" % marker)
+
+        if kind not in (0xA, 0xD):
+            # Containers are mutable, so only share scalars.
+            self.objects[ref] = value
+        return value
+
+
+def pyReadPlist(filepath):
+    """
+    Read a .plist file from filepath.  Return the unpacked root object
+    (which is usually a dictionary).
+    """
+    try:
+        with open(filepath, "rb") as plist_file:
+            data = plist_file.read(READ_CHUNK_SIZE)
+            if data.startswith(BINARY_HEADER):
+                return BinaryPlistParser(data + plist_file.read()).parse()
+            parser = XMLPlistParser()
+            while data:
+                parser.feed(data)
+                data = plist_file.read(READ_CHUNK_SIZE)
+            return parser.close()
+    except (IOError, OSError) as err:
+        raise NSPropertyListSerializationException(
+            "%s in file %s" % (err, filepath))
+    except NSPropertyListSerializationException as err:
+        raise NSPropertyListSerializationException(
+            "%s in file %s" % (err, filepath))
+
+
+def pyReadPlistFromString(data):
+    '''Read a plist data from a string. Return the root object.'''
+    if data.startswith(BINARY_HEADER):
+        return BinaryPlistParser(data).parse()
+    parser = XMLPlistParser()
+    parser.feed(data)
+    return parser.close()
+
+
+def pyWritePlist(dataObject, filepath):
+    '''
+    Write 'rootObject' as a plist to filepath.
+    '''
+    plistData = pyWritePlistToString(dataObject)
+    directory = os.path.dirname(os.path.abspath(filepath))
+    # Like Foundation's atomic writes, write to a temporary file and
+    # rename it over the destination.
+    temp_path = None
+    try:
+        handle, temp_path = tempfile.mkstemp(dir=directory, prefix=".")
+        with os.fdopen(handle, "wb") as temp_file:
+            temp_file.write(plistData)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_path, 0666 & ~umask)
+        os.rename(temp_path, filepath)
+    except (IOError, OSError):
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise NSPropertyListWriteException(
+            "Failed to write plist data to %s" % filepath)
+
+
+def pyWritePlistToString(rootObject):
+    '''Return 'rootObject' as a plist-formatted string.'''
+    try:
+        return plistlib.writePlistToString(rootObject)
+    except (TypeError, ValueError) as err:
+        raise NSPropertyListSerializationException(err)
+
+
+def iterPlistArray(filepath, keys=None):
+    """
+    Yield the items of the root array of the .plist file at filepath.
+
+    Args:
+        filepath (str): Path to a plist with an array root object.
+        keys (iterable of str): If provided, dict items only include
+            these keys.
+
+    XML plists are always streamed with the pure-Python parser, even
+    when Foundation is available, so only the items (and only their
+    requested keys) are held in memory. Binary plists are read in full
+    with readPlist first.
+    """
+    keys = frozenset(keys) if keys is not None else None
+    try:
+        plist_file = open(filepath, "rb")
+    except (IOError, OSError) as err:
+        raise NSPropertyListSerializationException(
+            "%s in file %s" % (err, filepath))
+
+    with plist_file:
+        data = plist_file.read(READ_CHUNK_SIZE)
+        if data.startswith(BINARY_HEADER):
+            for item in _iterArrayItems(readPlist(filepath)):
+                yield _projectItem(item, keys)
+            return
+
+        items = []
+        parser = XMLPlistParser(item_callback=items.append, item_keys=keys)
+        try:
+            while data:
+                parser.feed(data)
+                for item in items:
+                    yield item
+                del items[:]
+                data = plist_file.read(READ_CHUNK_SIZE)
+            root = parser.close()
+        except NSPropertyListSerializationException as err:
+            raise NSPropertyListSerializationException(
+                "%s in file %s" % (err, filepath))
+        for item in items:
+            yield item
+        if root is not None and not isinstance(root, list):
+            raise NSPropertyListSerializationException(
+                "Root object is not an array in file %s" % filepath)
+
+
+def _iterArrayItems(rootObject):
+    """Return rootObject's items, if it is an array."""
+    if isinstance(rootObject, (dict, basestring)) or not hasattr(
+            rootObject, "__iter__"):
+        raise NSPropertyListSerializationException(
+            "Root object is not an array")
+    return rootObject
+
+
+def _projectItem(item, keys):
+    """Return a dict item limited to keys, or other items unchanged."""
+    if keys is None or not hasattr(item, "keys"):
+        return item
+    return {key: item[key] for key in item.keys() if key in keys}
@@ -0,0 +1,516 @@
+#!/usr/bin/python
+# Copyright 2016 Shea G. Craig
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""benchmark
+
+Measure easy_rider's throughput against synthetic Munki repos.
+
+For each catalog size, a Munki repo with a production catalog (with
+several versions per product and realistically bulky receipts and
+installs), a directory of recipes, and a recipe list are generated.
+Each phase of an easy_rider run (catalog parsing, indexing, lookups,
+making overrides and writing them) is then timed on its own, followed
+by process_overrides end to end. autopkg is replaced by
+fake_autopkg.py, so this runs on any box with Python 2.7.
+"""
+
+
+import argparse
+import contextlib
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import easy_rider
+import FoundationPlist
+
+
+FAKE_AUTOPKG = os.path.join(BENCHMARK_DIR, "fake_autopkg.py")
+ITEM_TEMPLATE = """\t<dict>
+\t\t<key>catalogs</key>
+\t\t<array>
+\t\t\t<string>production</string>
+\t\t</array>
+\t\t<key>category</key>
+\t\t<string>Category %(category)d</string>
+\t\t<key>description</key>
+\t\t<string>%(name)s is a synthetic product for benchmarking.</string>
+\t\t<key>developer</key>
+\t\t<string>Developer %(developer)d</string>
+\t\t<key>display_name</key>
+\t\t<string>%(name)s</string>
+\t\t<key>installer_item_location</key>
+\t\t<string>apps/%(developer)d/%(name)s-%(version)s.dmg</string>
+\t\t<key>installs</key>
+\t\t<array>
+\t\t\t<dict>
+\t\t\t\t<key>CFBundleIdentifier</key>
+\t\t\t\t<string>com.example.%(name)s</string>
+\t\t\t\t<key>CFBundleShortVersionString</key>
+\t\t\t\t<string>%(version)s</string>
+\t\t\t\t<key>path</key>
+\t\t\t\t<string>/Applications/%(name)s.app</string>
+\t\t\t\t<key>type</key>
+\t\t\t\t<string>application</string>
+\t\t\t</dict>
+\t\t</array>
+\t\t<key>name</key>
+\t\t<string>%(name)s</string>
+\t\t<key>receipts</key>
+\t\t<array>
+%(receipts)s\t\t</array>
+\t\t<key>version</key>
+\t\t<string>%(version)s</string>
+\t</dict>
+"""
+RECEIPT_TEMPLATE = """\t\t\t<dict>
+\t\t\t\t<key>installed_size</key>
+\t\t\t\t<integer>%(size)d</integer>
+\t\t\t\t<key>packageid</key>
+\t\t\t\t<string>com.example.%(name)s.pkg%(index)d</string>
+\t\t\t\t<key>version</key>
+\t\t\t\t<string>%(version)s</string>
+\t\t\t</dict>
+"""
+PLIST_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" \
+"http://www.apple.com/DTDs/PropertyList-1.0.dtd">
+<plist version="1.0">
+<array>
+"""
+PLIST_FOOTER = "</array>\n</plist>\n"
+
+
+def main():
+    args = get_argument_parser().parse_args()
+    if args.measure_load:
+        measure_load(*args.measure_load)
+        return
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="easy_rider_bench")
+    easy_rider.CACHE_DIR = os.path.join(workdir, "cache")
+    easy_rider.AUTOPKG = write_autopkg_wrapper(workdir)
+    print "Plist backend: %s" % (
+        "Foundation" if FoundationPlist.haveFoundation() else "pure Python")
+    print "Working in %s" % workdir
+    try:
+        for size in args.sizes:
+            repo = generate_repo(
+                os.path.join(workdir, "repo-%d" % size), size, args.versions,
+                args.recipes, args.missing, args.hanging, args.existing)
+            run_benchmarks(repo, args)
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir)
+
+
+def get_argument_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[2])
+    parser.add_argument(
+        "-s", "--sizes", type=int, nargs="+", default=(1000, 10000),
+        help="Catalog sizes (number of pkginfos) to benchmark. "
+        "(Defaults to %(default)s)")
+    parser.add_argument(
+        "-v", "--versions", type=int, default=5,
+        help="Versions per product name. (Defaults to %(default)s)")
+    parser.add_argument(
+        "-r", "--recipes", type=int, default=100,
+        help="Recipes in the recipe list. (Defaults to %(default)s)")
+    parser.add_argument(
+        "--missing", type=int, default=5,
+        help="Recipes in the list without a recipe file, which make "
+        "fake_autopkg prompt. (Defaults to %(default)s)")
+    parser.add_argument(
+        "--hanging", type=int, default=1,
+        help="Recipes in the list that make fake_autopkg hang until "
+        "easy_rider times out. (Defaults to %(default)s)")
+    parser.add_argument(
+        "--existing", type=int, default=5,
+        help="Recipes in the list that already have an override. "
+        "(Defaults to %(default)s)")
+    parser.add_argument(
+        "-j", "--jobs", type=int, nargs="+", default=(1, 4),
+        help="--jobs values to benchmark autopkg with. "
+        "(Defaults to %(default)s)")
+    parser.add_argument(
+        "--delay", type=float, default=0.0,
+        help="Start-up delay of fake_autopkg in seconds, to emulate "
+        "autopkg's slower start. (Defaults to %(default)s)")
+    parser.add_argument(
+        "-w", "--workdir",
+        help="Directory to generate repos in; kept afterwards. (Defaults "
+        "to a temporary directory)")
+    parser.add_argument(
+        "-k", "--keep", action="store_true",
+        help="Keep the temporary working directory.")
+    parser.add_argument("--measure-load", nargs=2, help=argparse.SUPPRESS)
+    return parser
+
+
+class Repo(object):
+    """Paths and contents of a generated benchmark repo."""
+
+    def __init__(self, path, size, names, recipes):
+        self.path = path
+        self.size = size
+        self.names = names
+        self.recipes = recipes
+        self.catalog = os.path.join(path, "munki_repo", "catalogs",
+                                    "production")
+        self.recipe_dir = os.path.join(path, "recipes")
+        self.recipe_list = os.path.join(path, "recipe_list.txt")
+        self.override_dir = os.path.join(path, "overrides")
+
+
+def generate_repo(path, size, versions, recipe_count, missing, hanging,
+                  existing):
+    """Generate a Munki repo, recipes, and recipe list under path.
+
+    Args:
+        path (str): Directory to generate in (replaced if it exists).
+        size (int): Number of pkginfos in the production catalog.
+        versions (int): Versions of each product.
+        recipe_count (int): Number of resolvable recipes to list.
+        missing (int): Listed recipes with no recipe file.
+        hanging (int): Listed recipes that make fake_autopkg hang.
+        existing (int): Listed recipes that already have an override.
+
+    Returns:
+        Repo
+    """
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    random.seed(size)
+    name_count = max(size // versions, 1)
+    names = ["Product%06d" % index for index in xrange(name_count)]
+    os.makedirs(os.path.dirname(os.path.join(path, "munki_repo", "catalogs",
+                                             "production")))
+    repo = Repo(path, size, names, [])
+    write_catalog(repo.catalog, names, size)
+
+    os.makedirs(repo.recipe_dir)
+    for name in random.sample(names, min(recipe_count, len(names))):
+        recipe = "%s.munki" % name
+        input_values = {"NAME": name, "MUNKI_REPO_SUBDIR": "apps",
+                        "pkginfo": {"catalogs": ["testing"], "name": name}}
+        recipe_plist = {"Identifier": "com.example.munki.%s" % name,
+                        "Input": input_values, "Process": []}
+        FoundationPlist.writePlist(
+            recipe_plist, os.path.join(repo.recipe_dir, recipe + ".recipe"))
+        repo.recipes.append(recipe)
+
+    repo.recipes.extend("Missing%d.munki" % index for index in
+                        xrange(missing))
+    repo.recipes.extend("Hang%d.munki" % index for index in
+                        xrange(hanging))
+    repo.existing = repo.recipes[:existing]
+    with open(repo.recipe_list, "w") as recipe_list:
+        recipe_list.write("\n".join(repo.recipes) + "\n")
+    return repo
+
+
+def write_autopkg_wrapper(workdir):
+    """Write an 'autopkg' that runs fake_autopkg with this interpreter."""
+    path = os.path.join(workdir, "autopkg")
+    with open(path, "w") as wrapper:
+        wrapper.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (
+            sys.executable, FAKE_AUTOPKG))
+    os.chmod(path, 0755)
+    return path
+
+
+def write_catalog(catalog_path, names, size):
+    """Stream a synthetic XML catalog of size items to catalog_path."""
+    with open(catalog_path, "w") as catalog:
+        catalog.write(PLIST_HEADER)
+        for index in xrange(size):
+            name = names[index % len(names)]
+            version = "%d.%d.%d" % (random.randint(0, 20),
+                                    random.randint(0, 20),
+                                    random.randint(0, 200))
+            receipts = "".join(
+                RECEIPT_TEMPLATE % {"name": name, "index": receipt,
+                                    "size": random.randint(1, 100000),
+                                    "version": version}
+                for receipt in xrange(4))
+            catalog.write(ITEM_TEMPLATE % {
+                "name": name, "version": version, "receipts": receipts,
+                "category": index % 12, "developer": index % 97})
+        catalog.write(PLIST_FOOTER)
+
+
+def run_benchmarks(repo, args):
+    size_mb = os.path.getsize(repo.catalog) / 1024.0 / 1024.0
+    print
+    print "=" * 72
+    print "Catalog: %d pkginfos, %d names, %.1fMB; %d recipes listed" % (
+        repo.size, len(repo.names), size_mb, len(repo.recipes))
+    print "=" * 72
+
+    # Catalog parsing, in a fresh interpreter to get its peak RSS. The
+    # snapshot is written up front, as by the first of the processes
+    # sharing it.
+    easy_rider.CatalogSnapshot.write(
+        get_snapshot_path(repo.catalog), easy_rider.CatalogIndex(
+            easy_rider.load_catalog(repo.catalog, easy_rider.METADATA)),
+        easy_rider.get_record_keys(easy_rider.METADATA), "0" * 20)
+    # Both plist backends are compared when PyObjC is available.
+    modes = ["pyReadPlist", "load_catalog", "CatalogSnapshot"]
+    if FoundationPlist.haveFoundation():
+        modes.insert(0, "nsReadPlist")
+    for mode in modes:
+        output = subprocess.check_output(
+            [sys.executable, __file__, "--measure-load", mode, repo.catalog])
+        elapsed, rss = output.split()
+        report("parse catalog (%s)" % mode, float(elapsed),
+               "peak RSS %sMB" % rss)
+
+    with timer() as elapsed:
+        catalog = easy_rider.load_catalog(repo.catalog, easy_rider.METADATA)
+        production_cat = easy_rider.CatalogIndex(catalog)
+    report("load_catalog + CatalogIndex", elapsed())
+    easy_rider.get_catalog_index(repo.catalog, easy_rider.METADATA,
+                                 rebuild_cache=True)
+    with timer() as elapsed:
+        easy_rider.get_catalog_index(repo.catalog, easy_rider.METADATA)
+    report("get_catalog_index (cached)", elapsed())
+
+    lookups = 10000
+    names = [random.choice(repo.names) for _ in xrange(lookups)]
+    seconds = timeit.timeit(
+        lambda: [easy_rider.get_current_production_version_from_name(
+            name, production_cat) for name in names], number=1)
+    report("catalog lookup", seconds / lookups, "per lookup")
+    snapshot = easy_rider.CatalogSnapshot(get_snapshot_path(repo.catalog))
+    seconds = timeit.timeit(
+        lambda: [easy_rider.get_current_production_version_from_name(
+            name, snapshot) for name in names], number=1)
+    report("catalog lookup (CatalogSnapshot)", seconds / lookups,
+           "per lookup")
+
+    benchmark_template(catalog[:10000])
+
+    versions = [item.get("version") for item in catalog[:10000]]
+    easy_rider._version_keys.clear()
+    with timer() as elapsed:
+        sorted(versions, key=easy_rider.version_key)
+    report("sort %d versions (version_key)" % len(versions), elapsed())
+    try:
+        from distutils.version import LooseVersion
+    except ImportError:
+        pass
+    else:
+        with timer() as elapsed:
+            sorted(versions, key=LooseVersion)
+        report("sort %d versions (LooseVersion)" % len(versions), elapsed())
+
+    with timer() as elapsed:
+        recipe_index = easy_rider.get_recipe_index([repo.recipe_dir],
+                                                   use_cache=False)
+    report("RecipeIndex", elapsed())
+
+    os.environ["FAKE_AUTOPKG_RECIPES"] = repo.recipe_dir
+    os.environ["FAKE_AUTOPKG_DELAY"] = str(args.delay)
+    resolvable = [recipe for recipe in repo.recipes if
+                  recipe in recipe_index]
+    for jobs in args.jobs:
+        reset_override_dir(repo)
+        with timer() as elapsed:
+            list(easy_rider.make_overrides(repo.recipes, repo.override_dir,
+                                           jobs))
+        report("make_overrides (autopkg, --jobs %d)" % jobs, elapsed(),
+               "%d recipes" % len(repo.recipes))
+    reset_override_dir(repo)
+    with timer() as elapsed:
+        results = list(easy_rider.make_overrides(
+            resolvable, repo.override_dir, 1, recipe_index))
+    report("make_overrides (--in-process)", elapsed(),
+           "%d recipes" % len(resolvable))
+
+    overrides = [(path, override) for _, path, override, _ in results if
+                 override]
+    with timer() as elapsed:
+        for path, override in overrides:
+            FoundationPlist.writePlist(override, path)
+    report("writePlist overrides", elapsed(),
+           "%d overrides" % len(overrides))
+    with timer() as elapsed:
+        for path, _ in overrides:
+            FoundationPlist.readPlist(path)
+    report("readPlist overrides", elapsed(),
+           "%d overrides" % len(overrides))
+
+    end_to_end = [
+        ("autopkg", ["--jobs", "1"], None),
+        ("autopkg, --jobs %d" % max(args.jobs),
+         ["--jobs", str(max(args.jobs))], None),
+        ("autopkg, RecipeIndex", ["--jobs", "1"], recipe_index),
+        ("--in-process", ["--in-process"], recipe_index),
+        ("--in-process --refresh", ["--in-process", "--refresh"],
+         recipe_index)]
+    for label, options, index in end_to_end:
+        if "--refresh" not in options:
+            reset_override_dir(repo)
+        cli_args = easy_rider.get_argument_parser().parse_args(
+            ["--no_prompt", "-o", repo.override_dir] + options)
+        with quiet(), timer() as elapsed:
+            recipes = easy_rider.get_recipes(repo.recipe_list)
+            easy_rider.process_overrides(recipes, cli_args,
+                                         production_cat, {}, index)
+        report("process_overrides (%s)" % label, elapsed(),
+               "%.1f recipes/s" % (len(repo.recipes) / elapsed()))
+
+
+def benchmark_template(catalog):
+    """Time matching a rules-based PkginfoTemplate, and a linear scan."""
+    rules = get_template_rules()
+    overrides = [{"category": item.get("category"),
+                  "developer": item.get("developer"),
+                  "name": item.get("name"),
+                  "recipe": "%s.munki" % item.get("name"),
+                  "parent_recipe": "com.example.munki.%s" % item.get("name")}
+                 for item in catalog]
+    with timer() as elapsed:
+        template = easy_rider.PkginfoTemplate({"unattended_install": True},
+                                              rules)
+    report("compile PkginfoTemplate", elapsed(), "%d rules" % len(rules))
+    for label in ("first pass", "memoized"):
+        with timer() as elapsed:
+            for fields in overrides:
+                template.get_values(fields)
+        report("PkginfoTemplate.get_values (%s)" % label,
+               elapsed() / len(overrides), "per override")
+    with timer() as elapsed:
+        for fields in overrides:
+            match_linear(template.rules, fields)
+    report("linear scan of rules", elapsed() / len(overrides),
+           "per override")
+
+
+def get_template_rules():
+    """Return rules by category, developer, and parent recipe pattern."""
+    rules = [{"match": {"category": "Category %d" % category},
+              "pkginfo": {"unattended_install": category % 2 == 0}}
+             for category in xrange(12)]
+    rules.extend({"match": {"developer": "Developer %d" % developer},
+                  "pkginfo": {"blocking_applications": []}}
+                 for developer in xrange(0, 97, 3))
+    rules.extend({"match": {"category": "Category %d" % (number % 12)},
+                  "match_regex": {"name": r"Product\d{4}%d" % number},
+                  "pkginfo": {"minimum_os_version": "10.%d" % number}}
+                 for number in xrange(10, 60))
+    rules.extend({"match_regex": {"parent_recipe": r"\.munki\.Product0+%d$" %
+                                  number},
+                  "pkginfo": {"force_install_after_date": "2017"}}
+                 for number in xrange(20))
+    return rules
+
+
+def match_linear(rules, fields):
+    """Apply compiled PkginfoTemplate rules by testing every one."""
+    values = {}
+    for match, match_regex, pkginfo in rules:
+        if all(fields.get(field) == value for field, value in
+               match.iteritems()) and all(
+                   regex.search(fields.get(field) or "")
+                   for field, regex in match_regex):
+            values.update(pkginfo)
+    return values
+
+
+def reset_override_dir(repo):
+    """Empty the override dir, apart from the pre-existing overrides."""
+    if os.path.exists(repo.override_dir):
+        shutil.rmtree(repo.override_dir)
+    os.makedirs(repo.override_dir)
+    for recipe in repo.existing:
+        FoundationPlist.writePlist(
+            {"Identifier": "local.%s" % recipe, "Input": {},
+             "ParentRecipe": recipe},
+            os.path.join(repo.override_dir, recipe + ".recipe"))
+
+
+def measure_load(mode, catalog_path):
+    """Print the time and peak RSS (MB) of loading a catalog.
+
+    The nsReadPlist and pyReadPlist modes read the whole catalog with
+    that FoundationPlist backend. The CatalogSnapshot mode maps the
+    snapshot run_benchmarks wrote.
+    """
+    import resource
+    # Binds the Foundation names nsReadPlist uses, if available.
+    FoundationPlist.haveFoundation()
+    start = time.time()
+    if mode in ("nsReadPlist", "pyReadPlist"):
+        easy_rider.CatalogIndex(getattr(FoundationPlist, mode)(catalog_path))
+    elif mode == "CatalogSnapshot":
+        snapshot = easy_rider.CatalogSnapshot(get_snapshot_path(catalog_path))
+        snapshot.get_newest(easy_rider.decode_name(
+            snapshot.get_encoded_name(0)))
+    else:
+        easy_rider.CatalogIndex(
+            easy_rider.load_catalog(catalog_path, easy_rider.METADATA))
+    elapsed = time.time() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and KiB elsewhere.
+    divisor = 1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0
+    print elapsed, int(rss / divisor)
+
+
+def get_snapshot_path(catalog_path):
+    return os.path.join(os.path.dirname(catalog_path), ".snapshot")
+
+
+def report(label, seconds, note=""):
+    if seconds < 0.01:
+        duration = "%10.2fus" % (seconds * 1e6)
+    else:
+        duration = "%10.3fs " % seconds
+    print "%-44s %s  %s" % (label, duration, note)
+
+
+@contextlib.contextmanager
+def timer():
+    """Time a block; the yielded function returns the elapsed seconds."""
+    start = time.time()
+    times = []
+    yield lambda: times[0] if times else time.time() - start
+    times.append(time.time() - start)
+
+
+@contextlib.contextmanager
+def quiet():
+    """Discard stdout and stderr."""
+    stdout, stderr = sys.stdout, sys.stderr
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = sys.stderr = devnull
+        try:
+            yield
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+# Copyright 2016 Shea G. Craig
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""fake_autopkg
+
+Stand-in for `autopkg make-override`, for benchmarking easy_rider
+without autopkg.
+
+Recipes are looked up by short name in the directory named by the
+FAKE_AUTOPKG_RECIPES environment variable. Like autopkg, missing
+recipes get an offer to search GitHub, which waits for input. Recipes
+whose names contain "Hang" hang silently, to exercise easy_rider's
+timeout. FAKE_AUTOPKG_DELAY adds a start-up delay, in seconds.
+"""
+
+
+import os
+import plistlib
+import sys
+import time
+
+
+def main():
+    time.sleep(float(os.environ.get("FAKE_AUTOPKG_DELAY", 0)))
+    args = sys.argv[1:]
+    if not args or args[0] != "make-override":
+        sys.exit("fake_autopkg only supports make-override")
+    override_dir = os.path.expanduser("~/Library/AutoPkg/RecipeOverrides")
+    recipe = None
+    for arg in args[1:]:
+        if arg.startswith("--override-dir="):
+            override_dir = arg.split("=", 1)[1]
+        else:
+            recipe = arg
+
+    if "Hang" in recipe:
+        time.sleep(3600)
+
+    recipe_path = os.path.join(os.environ["FAKE_AUTOPKG_RECIPES"],
+                               recipe + ".recipe")
+    if not os.path.exists(recipe_path):
+        print "Didn't find a recipe for %s." % recipe
+        raw_input("Search GitHub AutoPkg repos for a %s recipe? [y/n]: " %
+                  recipe)
+        sys.exit(1)
+
+    override_path = os.path.join(override_dir, recipe + ".recipe")
+    if os.path.exists(override_path):
+        print >> sys.stderr, ("An override plist already exists at %s, "
+                              "will not overwrite it." % override_path)
+        sys.exit(1)
+
+    parent = plistlib.readPlist(recipe_path)
+    name, _, recipe_type = recipe.rpartition(".")
+    plistlib.writePlist(
+        {"Identifier": "local.%s.%s" % (recipe_type, name),
+         "Input": parent["Input"],
+         "ParentRecipe": parent["Identifier"]}, override_path)
+    print "Override file saved to %s" % override_path
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# Copyright 2016 Shea G. Craig
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""version_matrix
+
+Check easy_rider.version_key against distutils' LooseVersion.
+
+Every pair of VERSIONS must compare the same way with version_key as
+with LooseVersion padded with zero components to the same length, the
+way Munki's MunkiLooseVersion compares them. PADDING_PAIRS are the
+intentional differences from plain LooseVersion: versions that differ
+only by trailing zeros are equal. Exits non-zero on any disagreement.
+"""
+
+
+import os
+import sys
+from distutils.version import LooseVersion
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import easy_rider
+
+
+VERSIONS = (
+    "1", "1.0", "1.0.0", "1.0.1", "1.0.10", "1.0.2", "1.1", "1.10", "1.2",
+    "1.0b1", "1.0b2", "1.0b10", "1.0rc1", "1.0.a", "1.0-beta", "1.0_1",
+    "2.0", "2.0 Beta 3", "2.0B3", "10.0", "2016.01", "0.9", "0",
+    u"2.0b1", "1.0.0.0.1")
+PADDING_PAIRS = (("1", "1.0"), ("1.0", "1.0.0"), ("0", "0.0"),
+                 ("2016.01", "2016.1.0"))
+
+
+def main():
+    failures = []
+    for first in VERSIONS:
+        for second in VERSIONS:
+            expected = padded_cmp(first, second)
+            actual = cmp(easy_rider.version_key(first),
+                         easy_rider.version_key(second))
+            if expected != actual:
+                failures.append((first, second, expected, actual))
+    for first, second in PADDING_PAIRS:
+        if LooseVersion(first) == LooseVersion(second):
+            failures.append((first, second, "LooseVersion !=", 0))
+        if easy_rider.version_key(first) != easy_rider.version_key(second):
+            failures.append((first, second, 0, "version_key !="))
+
+    pairs = len(VERSIONS) ** 2 + len(PADDING_PAIRS)
+    for first, second, expected, actual in failures:
+        print "%r vs %r: expected %s, got %s" % (first, second, expected,
+                                                 actual)
+    print "%d of %d pairs agree." % (pairs - len(failures), pairs)
+    sys.exit(1 if failures else 0)
+
+
+def padded_cmp(first, second):
+    """Compare versions like LooseVersion, padding with zeros."""
+    first = LooseVersion(first).version
+    second = LooseVersion(second).version
+    length = max(len(first), len(second))
+    return cmp(first + [0] * (length - len(first)),
+               second + [0] * (length - len(second)))
+
+
+if __name__ == "__main__":
+    main()
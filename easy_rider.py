@@ -27,22 +27,89 @@ production version of that product, followed by metadata from the
 """
 
 
-import argparse
-from distutils.version import LooseVersion
-import fcntl
+import collections
+import contextlib
+import copy
+import cPickle
+import errno
+import hashlib
+import heapq
+import json
+import mmap
 import os
+import Queue
+import re
 import select
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import zlib
 
 import FoundationPlist
 
-
+# argparse, cProfile, ctypes, httplib, multiprocessing and pstats are
+# imported where they're used, so embedding easy_rider (see iter_overrides)
+# doesn't pay for them.
+
+
+AUTOPKG = "/usr/local/bin/autopkg"
+# Output of autopkg offering to search for a missing recipe.
+AUTOPKG_PROMPTS = ("Search GitHub AutoPkg repos", "[y/n]")
+AUTOPKG_TIMEOUT = 3
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "easy_rider")
+# Bump when the format of cached data changes.
+CACHE_VERSION = 4
+CATALOG_KEYS = ("name", "version", "installer_item_location")
 ENDC = "\033[0m"
+HTTP_TIMEOUT = 60
 METADATA = ("category", "description", "developer", "display_name")
+NAME_MATCH_THRESHOLD = 0.8
+NAME_SUGGESTIONS = 5
+# Characters ignored when comparing product names.
+NAME_NORMALIZE_RE = re.compile(r"[^a-z0-9]+")
+# Statuses of recipes finished in earlier runs, which --resume skips.
+FINISHED_STATUSES = ("written", "unchanged")
+# Every option, by attribute name, with its default; see get_options.
+DEFAULT_OPTIONS = {
+    "answers": None, "catalog": ["production"], "from_pkgsinfo": False,
+    "in_process": False, "jobs": 1, "journal": None, "json_lines": False,
+    "keys": METADATA, "match_threshold": NAME_MATCH_THRESHOLD,
+    "merge": None, "munki_repo": None, "no_cache": False,
+    "no_prompt": False, "override_dir": None, "pkginfo": None,
+    "profile": None, "quiet": False, "rebuild_cache": False,
+    "recipe_list": None, "recipes": None, "refresh": False,
+    "resume": False, "save_answers": None, "shard": None,
+    "snapshot": None, "specify_subdir": "", "stats": None,
+    "suppress_subdir": False, "watch": False}
+DEFAULT_OVERRIDE_DIR = "~/Library/AutoPkg/RecipeOverrides"
+DEFAULT_RECIPE_SEARCH_DIRS = (".", "~/Library/AutoPkg/Recipes",
+                              "/Library/AutoPkg/Recipes")
+OVERRIDE_EXISTS_RE = re.compile(
+    r"An override plist already exists at (.+?)"
+    r"(?:, will not overwrite it\.?)?\s*$", re.MULTILINE)
+PKGINFO_CHUNK_SIZE = 64
 PKGINFO_EXTENSIONS = (".pkginfo", ".plist")
+POLL_INTERVAL = 0.5
+PROFILE_LINES = 30
+READ_SIZE = 64 * 1024
 RECIPE_EXCLUSIONS = ("com.github.autopkg.munki.makecatalogs",)
+RECIPE_EXTENSIONS = (".recipe", ".recipe.plist", ".recipe.yaml")
+WRITE_BATCH_SIZE = 64
+# How long watched files must be quiet before a change is handled.
+WATCH_SETTLE = 1.0
+WATCH_POLL_INTERVAL = 2.0
+YAML_IDENTIFIER_RE = re.compile(r"^Identifier:\s*[\"']?([^\"'\s]+)",
+                                re.MULTILINE)
+YAML_PARENT_RECIPE_RE = re.compile(r"^ParentRecipe:\s*[\"']?([^\"'\s]+)",
+                                   re.MULTILINE)
 SEPARATOR = 20 * "-"
+# Same component split as distutils' LooseVersion.
+VERSION_COMPONENT_RE = re.compile(r"(\d+|[a-z]+|\.)")
 __version__ = "0.3.0"
 
 
@@ -50,173 +117,1923 @@ class Error(Exception):
     """Class for domain specific exceptions."""
 
 
-class TimeoutError(Error):
-    """Timeout limit exceeded since last I/O."""
+# What happened to a recipe, as yielded by iter_overrides. status is
+# the journal status; name and version are of the catalog pkginfo used,
+# pkginfo is the override's Input pkginfo, and phases are timings.
+RecipeResult = collections.namedtuple(
+    "RecipeResult", ("recipe", "status", "override_path", "name", "version",
+                     "pkginfo", "phases", "error"))
+
 
+class CatalogItem(object):
+    """Compact, read-only record of some of a pkginfo's values.
+
+    Supports the subset of the dict interface easy_rider uses, so it
+    can stand in for a full pkginfo dict. Records loaded together
+    share one key -> position mapping.
+    """
 
-class Popen(subprocess.Popen):
-    """Subclass of subprocess.Popen to add support for timeouts."""
+    __slots__ = ("positions", "values")
 
-    def timed_readline(self, f, timeout):
-        """Perform readline-like operation with timeout.
+    def __init__(self, positions, values):
+        """Create a record.
 
         Args:
-            f: file object to .readline() on
-            timeout: int, seconds of inactivity to raise error at
+            positions (dict): Map of key to index into values.
+            values (tuple): Values, or None for missing keys.
+        """
+        self.positions = positions
+        self.values = values
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        position = self.positions.get(key)
+        if position is None or self.values[position] is None:
+            return default
+        return self.values[position]
+
+
+class CatalogIndex(object):
+    """Munki catalog items grouped by name.
+
+    The catalog is scanned once, and the newest version of each name
+    is found up front, so lookups don't have to walk the catalog.
+    """
+
+    def __init__(self, catalog):
+        """Index a catalog.
+
+        Args:
+            catalog (list of dict): Munki catalog pkginfo items.
+        """
+        self.pkginfos = {}
+        for item in catalog:
+            name = item.get("name")
+            if name is not None:
+                self.pkginfos.setdefault(name, []).append(item)
+
+        self.newest = {
+            name: max(pkginfos, key=lambda x: version_key(x["version"]))
+            for name, pkginfos in self.pkginfos.items()}
+        # Trigram to names, name to trigram count, and trigram to (name,
+        # count) of names with it more than once, built by the first
+        # call to suggest.
+        self.trigrams = None
+        self.trigram_counts = None
+        self.trigram_repeats = None
+
+    @classmethod
+    def merge(cls, indexes):
+        """Merge indexes into one, in order of precedence.
+
+        For each name, the pkginfos of the first index that has it are
+        used, so each lookup is still a single probe.
+        """
+        merged = cls([])
+        for index in reversed(indexes):
+            merged.pkginfos.update(index.pkginfos)
+            merged.newest.update(index.newest)
+        return merged
+
+    def subset(self, names):
+        """Return an index of only the pkginfos of names."""
+        index = type(self)([])
+        for name in names:
+            if name in self.newest:
+                index.pkginfos[name] = self.pkginfos[name]
+                index.newest[name] = self.newest[name]
+        return index
+
+    def __contains__(self, name):
+        return name in self.newest
+
+    def __iter__(self):
+        return iter(self.newest)
+
+    def __len__(self):
+        return len(self.newest)
+
+    def get_newest(self, name):
+        """Return the newest pkginfo for name, or an empty dict."""
+        return self.newest.get(name, {})
+
+    def suggest(self, name, limit=NAME_SUGGESTIONS):
+        """Return the names most like name, for when it isn't found.
+
+        Names are compared by the Dice coefficient of their trigrams,
+        counting repeats, and ignoring case and punctuation. Only names
+        sharing a trigram with name are scored, using an index of
+        trigram to names.
+
+        Args:
+            name (str): Name, or other hint, to match.
+            limit (int): Maximum number of suggestions.
+
+        Returns:
+            list of (float score, str name), best first. Scores range
+            from 0 to 1, for names that are the same when normalized.
+        """
+        if self.trigrams is None:
+            self.trigrams = {}
+            self.trigram_counts = {}
+            self.trigram_repeats = {}
+            for candidate in self:
+                trigrams = get_trigrams(candidate)
+                self.trigram_counts[candidate] = sum(trigrams.itervalues())
+                for trigram, count in trigrams.iteritems():
+                    self.trigrams.setdefault(trigram, []).append(candidate)
+                    if count > 1:
+                        self.trigram_repeats.setdefault(trigram, []).append(
+                            (candidate, count))
+        query = get_trigrams(name)
+        shared = collections.Counter()
+        for trigram, query_count in query.iteritems():
+            shared.update(self.trigrams.get(trigram, ()))
+            # Trigrams repeated in both names are shared more than once.
+            if query_count > 1:
+                for candidate, count in self.trigram_repeats.get(trigram,
+                                                                 ()):
+                    shared[candidate] += min(query_count, count) - 1
+        query_count = sum(query.itervalues())
+        scored = [(2.0 * count / (query_count +
+                                  self.trigram_counts[candidate]),
+                   candidate) for candidate, count in shared.iteritems()]
+        return heapq.nsmallest(limit, scored, key=lambda x: (-x[0], x[1]))
+
+
+class CatalogSnapshot(CatalogIndex):
+    """Read-only CatalogIndex of newest items, memory-mapped from a file.
+
+    A snapshot is written once, and every process that opens it maps
+    the same pages, rather than each parsing (or unpickling) its own
+    copy of the catalog. Items are only decoded when looked up.
+
+    The file is a header (magic, signature, name count and length of
+    the pickled keys), the keys, then a table with an entry per name,
+    sorted by UTF-8 name, of (offset, name length, record length) into
+    the blob that follows. Each name in the blob is followed by its
+    record: the pickled values of its newest item.
+    """
+
+    ENTRY = struct.Struct("<III")
+    HEADER = struct.Struct("<8s20sII")
+    MAGIC = "ERSNAP01"
+
+    def __init__(self, path):
+        """Map a snapshot.
+
         Raises:
-            TimeoutError, if timeout is reached
+            Error: If path isn't a snapshot.
+        """
+        with open(path, "rb") as handle:
+            try:
+                self.map = mmap.mmap(handle.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError) as error:
+                raise Error("Unable to map snapshot %s: %s" % (path, error))
+        if len(self.map) < self.HEADER.size:
+            raise Error("%s is not a catalog snapshot." % path)
+        magic, self.signature, self.count, keys_length = (
+            self.HEADER.unpack_from(self.map))
+        if magic != self.MAGIC:
+            raise Error("%s is not a catalog snapshot." % path)
+        start = self.HEADER.size
+        keys = cPickle.loads(self.map[start:start + keys_length])
+        self.positions = {key: position for position, key in enumerate(keys)}
+        self.table = start + keys_length
+        self.blob = self.table + self.count * self.ENTRY.size
+        self.trigrams = None
+        self.trigram_counts = None
+        self.trigram_repeats = None
+
+    @classmethod
+    def write(cls, path, index, keys, signature):
+        """Atomically write a snapshot of index's newest items.
+
+        Args:
+            path (str): Path of the snapshot.
+            index (CatalogIndex): Index to snapshot.
+            keys (tuple of str): Keys of the values to keep, as
+                returned by get_record_keys.
+            signature (str): 20 byte digest of the index's sources, for
+                telling whether the snapshot is stale.
         """
-        set_file_nonblock(f)
+        names = sorted((encode_name(name), name) for name in index)
+        table = []
+        blob = []
+        offset = 0
+        for encoded, name in names:
+            item = index.get_newest(name)
+            record = cPickle.dumps(tuple(item.get(key) for key in keys),
+                                   cPickle.HIGHEST_PROTOCOL)
+            table.append(cls.ENTRY.pack(offset, len(encoded), len(record)))
+            blob.extend((encoded, record))
+            offset += len(encoded) + len(record)
+        pickled_keys = cPickle.dumps(tuple(keys), cPickle.HIGHEST_PROTOCOL)
+        temp_path = write_temp_file(path, "".join(
+            [cls.HEADER.pack(cls.MAGIC, signature, len(names),
+                             len(pickled_keys)), pickled_keys] + table +
+            blob))
+        os.rename(temp_path, path)
+
+    def close(self):
+        self.map.close()
+
+    def find(self, name):
+        """Return the table position of name, or None."""
+        encoded = encode_name(name)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_encoded_name(middle) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self.get_encoded_name(low) == encoded:
+            return low
+        return None
 
-        output = []
-        inactive = 0
-        while 1:
-            (rlist, dummy_wlist, dummy_xlist) = select.select(
-                [f], [], [], 1.0)
+    def get_encoded_name(self, position):
+        offset, name_length, _ = self.ENTRY.unpack_from(
+            self.map, self.table + position * self.ENTRY.size)
+        start = self.blob + offset
+        return self.map[start:start + name_length]
+
+    def __contains__(self, name):
+        return self.find(name) is not None
+
+    def __iter__(self):
+        for position in xrange(self.count):
+            yield decode_name(self.get_encoded_name(position))
+
+    def __len__(self):
+        return self.count
+
+    def get_newest(self, name):
+        """Return the newest CatalogItem for name, or an empty dict."""
+        position = self.find(name)
+        if position is None:
+            return {}
+        offset, name_length, record_length = self.ENTRY.unpack_from(
+            self.map, self.table + position * self.ENTRY.size)
+        start = self.blob + offset + name_length
+        return CatalogItem(self.positions, cPickle.loads(
+            self.map[start:start + record_length]))
+
+    def subset(self, names):
+        """Return a CatalogIndex of only the newest items of names."""
+        index = CatalogIndex([])
+        for name in names:
+            item = self.get_newest(name)
+            if item:
+                index.pkginfos[name] = [item]
+                index.newest[name] = item
+        return index
+
+
+def encode_name(name):
+    return name.encode("utf-8") if isinstance(name, unicode) else name
+
+
+def decode_name(encoded):
+    """Return a name as plist parsing does: str if ASCII, else unicode."""
+    try:
+        encoded.decode("ascii")
+    except UnicodeDecodeError:
+        return encoded.decode("utf-8")
+    return encoded
 
-            if not rlist:
-                inactive += 1  # approx -- py select doesn't return tv
-                if inactive >= timeout:
-                    break
+
+class RecipeIndex(object):
+    """Map of recipe identifiers and short names to recipe paths.
+
+    Recipes are resolved the way autopkg does it: by short name (the
+    file name without extension) first, then by identifier. The first
+    recipe found, in search directory order, wins.
+    """
+
+    def __init__(self, names, identifiers):
+        """Create an index.
+
+        Args:
+            names (dict): Recipe short name to path.
+            identifiers (dict): Recipe identifier to path.
+        """
+        self.names = names
+        self.identifiers = identifiers
+
+    def __contains__(self, recipe):
+        return self.resolve(recipe) is not None
+
+    def resolve(self, recipe):
+        """Return the path to a recipe, or None if it can't be found."""
+        if os.path.isfile(recipe):
+            return recipe
+        for extension in RECIPE_EXTENSIONS:
+            if recipe.endswith(extension):
+                recipe = recipe[:-len(extension)]
+                break
+        return self.names.get(recipe, self.identifiers.get(recipe))
+
+    def get_identifier(self, path):
+        """Return the identifier of the recipe at path, or None."""
+        if getattr(self, "paths", None) is None:
+            self.paths = {recipe_path: identifier for identifier, recipe_path
+                          in self.identifiers.items()}
+        identifier = self.paths.get(path)
+        return identifier if identifier else get_recipe_identifier(path)
+
+
+class OverrideIndex(object):
+    """The overrides in an override dir, by name, identifier and parent.
+
+    Names are file names without extension, which is how autopkg
+    make-override names an override after its recipe.
+    """
+
+    def __init__(self, directory, names, identifiers, parents):
+        """Create an index.
+
+        Args:
+            directory (str): The override dir.
+            names (dict): Override name to path.
+            identifiers (dict): Override identifier to path.
+            parents (dict): ParentRecipe identifier to the paths of
+                the overrides of it.
+        """
+        self.directory = directory
+        self.names = names
+        self.identifiers = identifiers
+        self.parents = parents
+
+    def find(self, recipe, recipe_index=None):
+        """Return the path of an existing override of recipe, or None.
+
+        An override matches if it has the name make-override would give
+        it, or if it is the recipe (by identifier). Other overrides of
+        the same ParentRecipe, e.g. Firefox-Testing.munki beside
+        Firefox.munki, are distinct overrides, so they don't match; see
+        find_others.
+        """
+        name, identifier = self._get_keys(recipe, recipe_index)
+        if name in self.names:
+            return self.names[name]
+        for candidate in (recipe, identifier):
+            if candidate in self.identifiers:
+                return self.identifiers[candidate]
+        return None
+
+    def find_others(self, recipe, recipe_index=None):
+        """Return paths of overrides of recipe that find doesn't match.
+
+        These are likely duplicates of the override make-override
+        makes, and are only reported.
+        """
+        identifier = self._get_keys(recipe, recipe_index)[1]
+        paths = set()
+        for candidate in (recipe, identifier):
+            paths.update(self.parents.get(candidate, ()))
+        paths.discard(self.find(recipe, recipe_index))
+        return sorted(paths)
+
+    def _get_keys(self, recipe, recipe_index):
+        """Return the override name and identifier recipe would have."""
+        recipe_path = (recipe_index.resolve(recipe) if recipe_index is not
+                       None else None)
+        identifier = None
+        name = os.path.basename(recipe_path or recipe)
+        extension = get_recipe_extension(name)
+        if extension:
+            name = name[:-len(extension)]
+        if recipe_path:
+            identifier = recipe_index.get_identifier(recipe_path)
+        return name, identifier
+
+
+class PkginfoTemplate(object):
+    """pkginfo values to enforce, overall and by rules, compiled once.
+
+    Each rule has 'match' conditions (field: exact string, number or
+    boolean value) and/or
+    'match_regex' conditions (field: regular expression searched for),
+    which must all hold, and the 'pkginfo' values it enforces. Fields are
+    the override's Input pkginfo values, plus 'recipe' (the recipe as
+    listed) and 'parent_recipe' (the identifier of the recipe it
+    overrides). Values are applied in order: the template's own
+    'pkginfo', then each matching rule's, in file order.
+
+    Rules are indexed by one of their exact conditions, so only those
+    that can match a set of fields are tested, and rules without any are
+    tested against precompiled regexes. The values for each distinct
+    combination of the fields rules use are memoized, unless one of
+    them is unhashable (e.g. an array).
+    """
+
+    def __init__(self, pkginfo=None, rules=()):
+        """Compile a template.
+
+        Args:
+            pkginfo (dict): Values enforced on every override.
+            rules (list of dict): Rules, as described above.
+
+        Raises:
+            Error: If a rule is malformed, or a regex is invalid.
+        """
+        self.pkginfo = dict(pkginfo or {})
+        self.sources = list(rules)
+        self.rules = []
+        # Field to value to numbers of the rules dispatched by it.
+        self.dispatch = {}
+        # Numbers of rules with no exact conditions.
+        self.undispatched = []
+        fields = set()
+        for number, rule in enumerate(self.sources):
+            if not hasattr(rule, "get") or not hasattr(
+                    rule.get("pkginfo"), "keys"):
+                raise Error("pkginfo template rule %d has no 'pkginfo' "
+                            "dict." % (number + 1))
+            match = rule.get("match") or {}
+            if not hasattr(match, "items"):
+                raise Error("pkginfo template rule %d 'match' is not a "
+                            "dict." % (number + 1))
+            match = dict(match)
+            for field, value in match.items():
+                if not is_hashable(value):
+                    raise Error("pkginfo template rule %d 'match' value "
+                                "for %s must be a string, number or "
+                                "boolean." % (number + 1, field))
+            match_regex = rule.get("match_regex") or {}
+            if not hasattr(match_regex, "items"):
+                raise Error("pkginfo template rule %d 'match_regex' is not "
+                            "a dict." % (number + 1))
+            try:
+                match_regex = [
+                    (field, re.compile(pattern)) for field, pattern in
+                    sorted(match_regex.items())]
+            except (re.error, TypeError) as error:
+                raise Error("pkginfo template rule %d has an invalid "
+                            "regex (%s)." % (number + 1, error))
+            self.rules.append((match, match_regex, dict(rule["pkginfo"])))
+            if match:
+                field = min(match)
+                self.dispatch.setdefault(field, {}).setdefault(
+                    match[field], []).append(number)
             else:
-                inactive = 0
-                c = f.read(1)
-                output.append(c)  # keep newline
-                if c == '' or c == '\n':
-                    break
+                self.undispatched.append(number)
+            fields.update(match)
+            fields.update(field for field, _ in match_regex)
+        self.fields = tuple(sorted(fields))
+        self.values = {}
 
-        set_file_nonblock(f, non_blocking=False)
+    def __nonzero__(self):
+        return bool(self.pkginfo or self.rules)
 
-        if inactive >= timeout:
-            raise TimeoutError  # note, an incomplete line can be lost
-        else:
-            return ''.join(output)
+    def __eq__(self, other):
+        return (isinstance(other, PkginfoTemplate) and
+                self.pkginfo == other.pkginfo and
+                self.sources == other.sources)
+
+    def __ne__(self, other):
+        return not self == other
 
-    def communicate(self, std_in=None, timeout=0):
-        """Communicate, optionally ending after a timeout of no activity.
+    def get_values(self, fields):
+        """Return the pkginfo values to enforce for a set of fields.
 
         Args:
-            std_in: str, to send on stdin
-            timeout: int, seconds of inactivity to raise error at
+            fields (dict): Field values (see above).
+
         Returns:
-            (str or None, str or None) for stdout, stderr
-        Raises:
-            TimeoutError, if timeout is reached
+            dict of pkginfo values. It's shared, so mustn't be changed.
+        """
+        key = tuple(fields.get(field) for field in self.fields)
+        if not is_hashable(key):
+            key = None
+        values = self.values.get(key) if key is not None else None
+        if values is None:
+            values = dict(self.pkginfo)
+            for number in self.get_matching_rules(fields):
+                values.update(self.rules[number][2])
+            if key is not None:
+                self.values[key] = values
+        return values
+
+    def get_matching_rules(self, fields):
+        """Return the numbers of the rules that match fields, in order."""
+        candidates = list(self.undispatched)
+        for field, rules_by_value in self.dispatch.iteritems():
+            value = fields.get(field)
+            if is_hashable(value):
+                candidates.extend(rules_by_value.get(value, ()))
+        matching = []
+        for number in sorted(candidates):
+            match, match_regex, _ = self.rules[number]
+            if all(fields.get(field) == value for field, value in
+                   match.iteritems()) and all(
+                       isinstance(fields.get(field), basestring) and
+                       regex.search(fields[field])
+                       for field, regex in match_regex):
+                matching.append(number)
+        return matching
+
+
+class RunJournal(object):
+    """Append-only, JSON-lines record of what happened to each recipe.
+
+    Each line records one status change of a recipe; the last one
+    wins. Lines are flushed as they are written, so the journal of an
+    interrupted run is complete up to the interruption.
+    """
+
+    def __init__(self, path, resume=False):
+        """Open a journal.
+
+        Args:
+            path (str): Path to the journal file.
+            resume (bool): Whether to load, and append to, an existing
+                journal rather than starting a new one.
+        """
+        self.path = path
+        self.entries = {}
+        if resume:
+            self.entries = read_journal(path)
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.journal_file = open(path, "a" if resume else "w")
+
+    def get_status(self, recipe):
+        return self.entries.get(recipe, {}).get("status")
+
+    def is_finished(self, recipe):
+        return self.get_status(recipe) in FINISHED_STATUSES
+
+    def record(self, recipe, status, path=None):
+        entry = {"recipe": recipe, "status": status, "path": path,
+                 "time": time.time()}
+        self.entries[recipe] = entry
+        self.journal_file.write(json.dumps(entry) + "\n")
+        self.journal_file.flush()
+
+    def close(self):
+        self.journal_file.close()
+
+
+class RunStats(object):
+    """Wall time and counts for each phase of a run, and each recipe.
+
+    Phases may nest (e.g. 'lookup' time is also part of
+    'update_override' time).
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = collections.OrderedDict()
+        self.counts = collections.Counter()
+        self.recipes = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name, recipe=None):
+        """Time a block as part of phase name (and of recipe)."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start, recipe)
+
+    def add_time(self, name, seconds, recipe=None):
+        phase = self.phases.setdefault(name, {"seconds": 0.0, "count": 0})
+        phase["seconds"] += seconds
+        phase["count"] += 1
+        if recipe is not None:
+            recipe_phases = self.get_recipe(recipe)["phases"]
+            recipe_phases[name] = recipe_phases.get(name, 0.0) + seconds
+
+    def count(self, name, amount=1):
+        self.counts[name] += amount
+
+    def set_status(self, recipe, status):
+        """Record a recipe's latest status; final statuses are counted."""
+        self.get_recipe(recipe)["status"] = status
+
+    def get_recipe(self, recipe):
+        return self.recipes.setdefault(recipe, {"status": None, "phases": {}})
+
+    def report(self):
+        """Return the stats as a JSON-serializable dict."""
+        statuses = collections.Counter(
+            recipe["status"] for recipe in self.recipes.values())
+        return {"started": self.started,
+                "seconds": time.time() - self.started,
+                "phases": self.phases,
+                "counts": dict(self.counts),
+                "statuses": dict(statuses),
+                "recipes": self.recipes}
+
+    def write(self, path):
+        with open(path, "w") as stats_file:
+            json.dump(self.report(), stats_file, indent=2)
+
+
+class OverrideWriter(object):
+    """Writes overrides from a background thread, in batches.
+
+    Queued overrides are serialized off the main thread and written to
+    temporary files, which are synced and then renamed over the
+    overrides, so a crash never leaves a truncated override. Each
+    directory written to is synced once per batch.
+    """
+
+    def __init__(self, batch_size=WRITE_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.queue = Queue.Queue()
+        self.results = Queue.Queue()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, recipe, status, override, path):
+        """Queue an override to be written.
+
+        Args:
+            recipe (str): Recipe the override is for.
+            status (str): make_overrides status. 'exists' overrides are
+                only written if their content has changed.
+            override (Plist): Override to write. It mustn't be changed
+                once queued.
+            path (str): Path to write to.
         """
-        if timeout <= 0:
-            return super(Popen, self).communicate(input=std_in)
-
-        fds = []
-        stdout = []
-        stderr = []
-
-        if self.stdout is not None:
-            set_file_nonblock(self.stdout)
-            fds.append(self.stdout)
-        if self.stderr is not None:
-            set_file_nonblock(self.stderr)
-            fds.append(self.stderr)
-
-        if std_in is not None and sys.stdin is not None:
-            sys.stdin.write(std_in)
-
-        returncode = None
-        inactive = 0
-        while returncode is None:
-            (rlist, dummy_wlist, dummy_xlist) = select.select(
-                fds, [], [], 1.0)
-
-            if not rlist:
-                inactive += 1
-                if inactive >= timeout:
-                    raise TimeoutError
+        self.queue.put((recipe, status, override, path))
+
+    def finished(self):
+        """Return the results of the writes finished so far.
+
+        Returns:
+            list of (recipe, status, path, result, seconds), in the
+            order written, where result is 'written', 'unchanged' or an
+            error message.
+        """
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except Queue.Empty:
+                return results
+
+    def close(self):
+        """Wait for all queued writes, and return the unreported results."""
+        self.queue.put(None)
+        self.thread.join()
+        return self.finished()
+
+    def run(self):
+        closed = False
+        while not closed:
+            batch = []
+            item = self.queue.get()
+            while item is not None:
+                batch.append(item)
+                if len(batch) == self.batch_size:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+            closed = item is None
+            for result in self.write_batch(batch):
+                self.results.put(result)
+
+    def write_batch(self, batch):
+        results = []
+        renames = []
+        for recipe, status, override, path in batch:
+            start = time.time()
+            result = [recipe, status, path, "written", None]
+            try:
+                data = FoundationPlist.writePlistToString(override)
+                if status == "exists" and read_file(path) == data:
+                    result[3] = "unchanged"
+                else:
+                    renames.append((write_temp_file(path, data), result))
+            except (FoundationPlist.FoundationPlistException,
+                    EnvironmentError) as error:
+                result[3] = str(error)
+            result[4] = time.time() - start
+            results.append(result)
+
+        directories = set()
+        for temp_path, result in renames:
+            path = result[2]
+            try:
+                os.rename(temp_path, path)
+            except EnvironmentError as error:
+                os.remove(temp_path)
+                result[3] = str(error)
             else:
-                inactive = 0
-                for fd in rlist:
-                    if fd is self.stdout:
-                        stdout.append(fd.read())
-                    elif fd is self.stderr:
-                        stderr.append(fd.read())
+                directories.add(os.path.dirname(os.path.abspath(path)))
+        for directory in directories:
+            fsync_directory(directory)
+        return [tuple(result) for result in results]
 
-            returncode = self.poll()
 
-        if self.stdout is not None:
-            stdout = ''.join(stdout)
-        else:
-            stdout = None
-        if self.stderr is not None:
-            stderr = ''.join(stderr)
-        else:
-            stderr = None
+_version_keys = {}
+
+
+def is_hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+def get_trigrams(name):
+    """Return a Counter of the trigrams of a normalized, padded name.
+
+    Repeats are counted, so only names that are the same when
+    normalized have the same trigrams.
+    """
+    normalized = NAME_NORMALIZE_RE.sub("", (name or "").lower())
+    if not normalized:
+        return collections.Counter()
+    padded = "  %s " % normalized
+    return collections.Counter(padded[i:i + 3] for i in
+                               xrange(len(padded) - 2))
+
+
+def version_key(version):
+    """Return a sort key for a Munki version string.
+
+    Versions are split into components like distutils' LooseVersion,
+    and, like Munki's MunkiLooseVersion, compare as if padded with
+    zero components to the same length (so "1.0" == "1.0.0"). As in
+    Python 2's LooseVersion comparisons, numeric components sort before
+    alphabetic ones. Keys are plain tuples and are memoized, since the
+    same versions are compared many times.
+
+    Args:
+        version: Version string (other types are converted with str).
+
+    Returns:
+        tuple of (0, int) and (1, str) components.
+    """
+    try:
+        return _version_keys[version]
+    except KeyError:
+        pass
+    except TypeError:
+        # Unhashable; don't memoize.
+        return _make_version_key(version)
+    key = _version_keys[version] = _make_version_key(version)
+    return key
+
+
+def _make_version_key(version):
+    if isinstance(version, unicode):
+        vstring = version.encode("utf-8")
+    else:
+        vstring = str(version)
+    key = [(0, int(component)) if component.isdigit() else (1, component)
+           for component in VERSION_COMPONENT_RE.split(vstring)
+           if component and component != "."]
+    while key and key[-1] == (0, 0):
+        key.pop()
+    return tuple(key)
+
 
-        return (stdout, stderr)
+class Command(object):
+    """A child process run by a CommandRunner."""
+
+    def __init__(self, args, timeout=0, prompts=()):
+        """Set up a command.
+
+        Args:
+            args (list of str): Command and arguments.
+            timeout (float): Seconds of inactivity after which to kill
+                the process, or 0 for no timeout.
+            prompts (iterable of str): Output that means the process
+                is waiting for interactive input it won't get; if seen,
+                the process is killed.
+        """
+        self.args = args
+        self.timeout = timeout
+        self.prompts = prompts
+        self.proc = None
+        self.streams = {}
+        self.output = {"stdout": [], "stderr": []}
+        self.last_activity = None
+        self.returncode = None
+        self.timed_out = False
+        self.prompted = False
+
+    @property
+    def stdout(self):
+        return "".join(self.output["stdout"])
+
+    @property
+    def stderr(self):
+        return "".join(self.output["stderr"])
+
+    @property
+    def finished(self):
+        return self.returncode is not None
+
+    def start(self):
+        self.proc = subprocess.Popen(
+            self.args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, close_fds=True)
+        self.streams = {self.proc.stdout.fileno(): "stdout",
+                        self.proc.stderr.fileno(): "stderr"}
+        self.last_activity = monotonic()
+
+    def read(self, fd):
+        """Read available output from fd, closing it at EOF."""
+        data = os.read(fd, READ_SIZE)
+        if not data:
+            del self.streams[fd]
+            return
+        self.last_activity = monotonic()
+        self.output[self.streams[fd]].append(data)
+        # A prompt may be split across reads, so check the tail.
+        tail = "".join(self.output[self.streams[fd]][-2:])
+        if any(prompt in tail for prompt in self.prompts):
+            self.prompted = True
+            self.kill()
+
+    def deadline(self):
+        if not self.timeout:
+            return None
+        return self.last_activity + self.timeout
+
+    def kill(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.kill()
+
+    def finish(self):
+        """Reap the process once its output is closed, or it was killed."""
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+        self.streams = {}
+        self.returncode = self.proc.wait()
+
+
+class CommandRunner(object):
+    """Runs many Commands from one select loop.
+
+    Output is read in chunks as soon as it is available, and timeouts
+    are checked against a monotonic clock (see monotonic), so hung or
+    prompting processes are caught within a fraction of a second, and
+    setting the system clock doesn't fire or postpone them.
+    """
+
+    def __init__(self, commands, max_running=1):
+        """Set up a runner.
+
+        Args:
+            commands (list of Command): Commands to run.
+            max_running (int): Maximum number of concurrent processes.
+        """
+        self.commands = list(commands)
+        self.max_running = max(max_running, 1)
+        self.running = []
+        self.stopped = False
+
+    def run(self):
+        """Run the commands, yielding each, in order, once finished."""
+        waiting = collections.deque(self.commands)
+        next_result = 0
+        try:
+            while next_result < len(self.commands) and not self.stopped:
+                while waiting and len(self.running) < self.max_running:
+                    command = waiting.popleft()
+                    command.start()
+                    self.running.append(command)
+
+                self.poll()
+
+                while (next_result < len(self.commands) and
+                       self.commands[next_result].finished):
+                    yield self.commands[next_result]
+                    next_result += 1
+        finally:
+            self.kill_all()
+
+    def poll(self):
+        """Wait for, and handle, output or timeouts of running commands."""
+        fds = {}
+        for command in self.running:
+            for fd in command.streams:
+                fds[fd] = command
+        deadlines = [command.deadline() for command in self.running
+                     if command.deadline() is not None]
+        wait = (max(min(deadlines) - monotonic(), 0) if deadlines else
+                POLL_INTERVAL)
+        # A running command always has open output until it finishes.
+        if fds:
+            try:
+                readable = select.select(list(fds), [], [], wait)[0]
+            except select.error as error:
+                if error.args[0] != errno.EINTR:
+                    raise
+                readable = []
+            for fd in readable:
+                fds[fd].read(fd)
+
+        now = monotonic()
+        for command in list(self.running):
+            if command.streams and not command.prompted:
+                deadline = command.deadline()
+                if deadline is None or now < deadline:
+                    continue
+                command.timed_out = True
+                command.kill()
+            command.finish()
+            self.running.remove(command)
+
+    def stop(self):
+        """Stop running, from another thread; running processes are killed."""
+        self.stopped = True
+
+    def kill_all(self):
+        for command in self.running:
+            command.kill()
+            command.finish()
+        self.running = []
+
+
+class HTTPRepo(object):
+    """A Munki repo served over HTTP(S).
+
+    Files are fetched over one keep-alive connection, gzipped if the
+    server will, into a local cache. Cached files are revalidated with
+    If-None-Match and If-Modified-Since, so an unchanged file costs one
+    304 response. Credentials in the URL are sent as basic auth.
+    """
+
+    def __init__(self, url, timeout=HTTP_TIMEOUT):
+        import urlparse
+        parsed = urlparse.urlsplit(url)
+        self.scheme = parsed.scheme
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.path = parsed.path.rstrip("/")
+        # For messages and cache names, so without any credentials.
+        netloc = "[%s]" % self.host if ":" in self.host else self.host
+        if self.port:
+            netloc += ":%d" % self.port
+        self.url = "%s://%s%s" % (self.scheme, netloc, self.path)
+        self.timeout = timeout
+        self.headers = {"Accept-Encoding": "gzip",
+                        "User-Agent": "easy_rider/%s" % __version__}
+        if parsed.username:
+            credentials = "%s:%s" % (parsed.username, parsed.password or "")
+            self.headers["Authorization"] = "Basic %s" % (
+                credentials.encode("base64").replace("\n", ""))
+        self.connection = None
+
+    def fetch(self, path):
+        """Return the path of an up-to-date local copy of a repo file.
+
+        If the repo can't be reached, or the file can't be saved (e.g.
+        the disk is full, or the gzipped body is corrupt), a cached copy
+        is used, with a warning.
+
+        Args:
+            path (str): Path of the file, relative to the repo root.
+
+        Raises:
+            Error: If the file can't be fetched, and isn't cached.
+        """
+        import httplib
+        import urllib
+        url = "%s/%s" % (self.path, urllib.quote(path))
+        cache_name = "http-%s" % hashlib.sha1(
+            "%s/%s" % (self.url, path)).hexdigest()
+        cache_path = os.path.join(CACHE_DIR, cache_name + ".data")
+        validators = read_cache(cache_name) if os.path.exists(
+            cache_path) else None
+        headers = dict(self.headers)
+        if validators and validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators and validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+        try:
+            response = self.request(url, headers)
+            if response.status == 304:
+                response.read()
+                return cache_path
+            if response.status != 200:
+                response.read()
+                raise Error("Unable to fetch %s/%s: %d %s" % (
+                    self.url, path, response.status, response.reason))
+            self.save(response, cache_path)
+        # socket.error is an EnvironmentError, as are local I/O errors.
+        except (httplib.HTTPException, EnvironmentError, zlib.error) as error:
+            self.close()
+            if validators is None:
+                raise Error("Unable to fetch %s/%s: %s" % (self.url, path,
+                                                           error))
+            print_error("Unable to fetch %s/%s (%s); using the cached "
+                        "copy." % (self.url, path, error))
+            return cache_path
+        write_cache(cache_name, {
+            "etag": response.getheader("ETag"),
+            "last_modified": response.getheader("Last-Modified")})
+        return cache_path
+
+    def request(self, url, headers):
+        """GET url, reconnecting once if the kept-alive connection died."""
+        import httplib
+        import socket
+        for attempt in (1, 2):
+            if self.connection is None:
+                connection_class = (httplib.HTTPSConnection if
+                                    self.scheme == "https" else
+                                    httplib.HTTPConnection)
+                self.connection = connection_class(
+                    self.host, self.port, timeout=self.timeout)
+            try:
+                self.connection.request("GET", url, headers=headers)
+                return self.connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                self.close()
+                if attempt == 2:
+                    raise
+
+    def save(self, response, cache_path):
+        """Stream a response's body, decompressed, to cache_path."""
+        decompressor = None
+        if response.getheader("Content-Encoding", "").lower() == "gzip":
+            # 16 + MAX_WBITS accepts a gzip header.
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        handle, temp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix=".")
+        try:
+            with os.fdopen(handle, "wb") as temp_file:
+                while True:
+                    data = response.read(READ_SIZE)
+                    if not data:
+                        break
+                    temp_file.write(decompressor.decompress(data) if
+                                    decompressor else data)
+                if decompressor:
+                    temp_file.write(decompressor.flush())
+            os.rename(temp_path, cache_path)
+        except (EnvironmentError, zlib.error):
+            os.remove(temp_path)
+            raise
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class FileWatcher(object):
+    """Waits for changes to a set of files and directories.
+
+    On Linux, changes are watched for with inotify, through ctypes;
+    elsewhere, or if inotify can't be used, the paths are polled.
+    Parent directories are watched rather than files, so files replaced
+    by a rename (as makecatalogs and most editors do) are still seen.
+    Directories are watched recursively.
+    """
+
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+    IN_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+               IN_DELETE)
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, paths):
+        """Start watching.
+
+        Args:
+            paths (iterable of str): Files and directories to watch.
+                They needn't exist yet, but their parents should.
+        """
+        # Absolute path to the path as given, which is what's returned.
+        self.paths = {os.path.abspath(path): path for path in paths}
+        self.fd = None
+        self.watches = {}
+        self.signatures = {}
+        if sys.platform.startswith("linux"):
+            try:
+                self.start_inotify()
+            except (AttributeError, OSError):
+                self.close()
+        if self.fd is None:
+            self.signatures = {path: get_signature(path) for path in
+                               self.paths}
+
+    def start_inotify(self):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            self.fd = None
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        for path in self.paths:
+            self.add_watch(os.path.dirname(path))
+            if os.path.isdir(path):
+                for dirpath, _, _ in os.walk(path):
+                    self.add_watch(dirpath)
+
+    def add_watch(self, path):
+        import ctypes
+        if path in self.watches.values():
+            return
+        wd = self.libc.inotify_add_watch(self.fd, path, self.IN_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        self.watches[wd] = path
+
+    def wait(self):
+        """Block until a watched path changes.
+
+        Changes are collected until there have been none for
+        WATCH_SETTLE seconds, so a batch of writes is handled once.
+
+        Returns:
+            set of str: The watched paths that changed.
+        """
+        changed = set()
+        while not changed:
+            changed = self.get_changes(None)
+        while True:
+            more = self.get_changes(WATCH_SETTLE)
+            if not more:
+                return changed
+            changed.update(more)
+
+    def get_changes(self, timeout):
+        """Return the watched paths changed within timeout seconds.
+
+        With a timeout of None, wait for at least one event (inotify)
+        or poll interval (polling).
+        """
+        if self.fd is None:
+            time.sleep(WATCH_POLL_INTERVAL if timeout is None else timeout)
+            changed = set()
+            for path in self.paths:
+                signature = get_signature(path)
+                if signature != self.signatures[path]:
+                    self.signatures[path] = signature
+                    changed.add(self.paths[path])
+            return changed
+
+        try:
+            readable = select.select([self.fd], [], [], timeout)[0]
+        except select.error as error:
+            if error.args[0] != errno.EINTR:
+                raise
+            readable = []
+        if not readable:
+            return set()
+        return self.read_events(os.read(self.fd, READ_SIZE))
+
+    def read_events(self, data):
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                # Events were lost; assume everything changed.
+                return set(self.paths.values())
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name)
+            for watched in self.paths:
+                if path == watched or path.startswith(watched + os.sep):
+                    changed.add(self.paths[watched])
+                    if mask & self.IN_ISDIR and mask & (self.IN_CREATE |
+                                                        self.IN_MOVED_TO):
+                        self.add_watch(path)
+        return changed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
 
 
 def main():
     """Set up arguments and start processing."""
     args = get_argument_parser().parse_args()
+    if args.merge:
+        merge_reports(args.merge, args.journal, args.stats)
+        return
+    stats = RunStats()
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        run(args, stats)
+    except Error as error:
+        sys.exit(str(error))
+    finally:
+        if profiler:
+            profiler.disable()
+            write_profile(profiler, args.profile)
+        if args.stats:
+            stats.write(args.stats)
+
+
+def merge_reports(paths, journal_path=None, stats_path=None):
+    """Merge the journals and --stats reports of sharded runs.
+
+    A recipe's last journal entry, across all the journals, wins. A
+    summary of recipe statuses is printed.
+
+    Args:
+        paths (list of str): Journals and stats reports, in any order.
+        journal_path (str): If provided, the merged journal is written
+            here.
+        stats_path (str): If provided, the merged stats report is
+            written here.
+    """
+    journal_entries = {}
+    reports = []
+    for path in paths:
+        with open(path) as report_file:
+            try:
+                report = json.load(report_file)
+            except ValueError:
+                # A JSON-lines journal of several entries.
+                report = None
+        if isinstance(report, dict) and "phases" in report:
+            reports.append(report)
+            continue
+        for recipe, entry in read_journal(path).items():
+            if (recipe not in journal_entries or
+                    entry["time"] >= journal_entries[recipe]["time"]):
+                journal_entries[recipe] = entry
+
+    if journal_path:
+        with open(journal_path, "w") as journal_file:
+            for entry in sorted(journal_entries.values(),
+                                key=lambda x: x["time"]):
+                journal_file.write(json.dumps(entry) + "\n")
+    report = merge_stats_reports(reports) if reports else None
+    if stats_path and report:
+        with open(stats_path, "w") as stats_file:
+            json.dump(report, stats_file, indent=2)
+
+    if journal_entries:
+        statuses = collections.Counter(
+            entry["status"] for entry in journal_entries.values())
+    else:
+        statuses = collections.Counter(report["statuses"] if report else {})
+    print "Merged %d journal(s) and %d stats report(s)." % (
+        len(paths) - len(reports), len(reports))
+    for status, count in sorted(statuses.items()):
+        print "\t%s: %d" % (status, count)
+
+
+def merge_stats_reports(reports):
+    """Combine RunStats.report dicts into one.
+
+    Phase times and counts are summed; the merged run spans from the
+    first shard's start to the last shard's end.
+    """
+    phases = collections.OrderedDict()
+    counts = collections.Counter()
+    recipes = collections.OrderedDict()
+    for report in reports:
+        for name, phase in report["phases"].items():
+            merged = phases.setdefault(name, {"seconds": 0.0, "count": 0})
+            merged["seconds"] += phase["seconds"]
+            merged["count"] += phase["count"]
+        counts.update(report["counts"])
+        recipes.update(report["recipes"])
+    started = min(report["started"] for report in reports)
+    ended = max(report["started"] + report["seconds"] for report in reports)
+    statuses = collections.Counter(
+        recipe["status"] for recipe in recipes.values())
+    return {"started": started,
+            "seconds": ended - started,
+            "phases": phases,
+            "counts": dict(counts),
+            "statuses": dict(statuses),
+            "recipes": recipes,
+            "shards": len(reports)}
+
+
+def run(args, stats):
+    """Load everything a run needs and process the overrides."""
+    stdout = sys.stdout
+    json_output = None
+    if args.json_lines:
+        # stdout is kept for results; messages go to stderr instead.
+        json_output, sys.stdout = sys.stdout, sys.stderr
+    if args.quiet:
+        args.no_prompt = True
+        sys.stdout = open(os.devnull, "w")
     autopkg_prefs = FoundationPlist.readPlist(
         os.path.expanduser("~/Library/Preferences/com.github.autopkg.plist"))
-    MUNKI_REPO = autopkg_prefs.get("MUNKI_REPO")
-    production_cat = FoundationPlist.readPlist(
-        os.path.join(MUNKI_REPO, "catalogs/%s" % args.catalog))
+    MUNKI_REPO = args.munki_repo or autopkg_prefs.get("MUNKI_REPO")
+    if is_url(MUNKI_REPO) and (args.from_pkgsinfo or args.watch):
+        sys.exit("--from-pkgsinfo and --watch need a local Munki repo.")
+    if args.in_process and not args.override_dir:
+        args.override_dir = get_override_dir(autopkg_prefs)
+    if args.watch:
+        # Watching keeps existing overrides in sync, so they are
+        # refreshed rather than skipped.
+        args.refresh = True
+    with stats.phase("index_recipes"):
+        recipe_index = get_recipe_index(
+            get_recipe_search_dirs(autopkg_prefs),
+            use_cache=not args.no_cache, rebuild_cache=args.rebuild_cache)
+    with stats.phase("index_overrides"):
+        override_index = get_override_index(
+            args.override_dir or get_override_dir(autopkg_prefs),
+            use_cache=not args.no_cache, rebuild_cache=args.rebuild_cache)
+
+    recipes = args.recipes if args.recipes else get_recipes(args.recipe_list)
+    if args.shard:
+        recipes = get_shard(recipes, args.shard, recipe_index)
+        print "Shard %d/%d: %d recipes." % (args.shard + (len(recipes),))
+    answers = (FoundationPlist.readPlist(os.path.expanduser(args.answers))
+               if args.answers else {})
+    with stats.phase("load_catalog"):
+        production_cat = get_production_cat(
+            args, MUNKI_REPO,
+            get_catalog_names(recipes, args, recipe_index, answers))
     pkginfo_template = (get_pkginfo_template(args.pkginfo) if args.pkginfo else
                         {})
 
-    recipes = args.recipes if args.recipes else get_recipes(args.recipe_list)
+    journal = RunJournal(
+        args.journal or get_journal_path(args.override_dir, args.shard),
+        args.resume)
+    product_names = {}
     try:
-        process_overrides(recipes, args, production_cat, pkginfo_template)
+        with stats.phase("process_overrides"):
+            process_overrides(recipes, args, production_cat, pkginfo_template,
+                              recipe_index, journal, answers, stats,
+                              product_names, json_output, override_index)
+        if args.watch:
+            watch(recipes, args, MUNKI_REPO, production_cat,
+                  pkginfo_template, recipe_index, journal, answers, stats,
+                  product_names, json_output, override_index)
     except KeyboardInterrupt:
-        print_error("Bailing!")
+        stats.count("interrupted")
+        print_error("Bailing! Use --resume to pick up where this run left "
+                    "off.")
     finally:
+        journal.close()
+        if args.save_answers:
+            FoundationPlist.writePlist(
+                answers, os.path.expanduser(args.save_answers))
         reset_term_colors()
+        sys.stdout = stdout
+
+
+def watch(recipes, args, munki_repo, production_cat, pkginfo_template,
+          recipe_index, journal, answers, stats, product_names,
+          json_output=None, override_index=None):
+    """Keep overrides up to date until interrupted.
 
+    The recipe list, the catalogs (or pkgsinfo) and the pkginfo
+    template are watched. On a change, only the overrides it affects
+    are refreshed: new recipes, those whose product's newest catalog
+    item changed, or all of them if the template changed. The catalog
+    index is kept between passes, and only changed catalogs are
+    re-parsed. Refreshes never prompt.
 
-def process_overrides(recipes, args, production_cat, pkginfo_template):
+    Args:
+        recipes (list of str): Recipes processed by the first run.
+        product_names (dict): Recipe to product name, as filled in by
+            process_overrides.
+        json_output (file): As for process_overrides.
+        override_index (OverrideIndex): As for process_overrides. It is
+            brought up to date before each pass.
+        Others: As for process_overrides.
+    """
+    args = copy.copy(args)
+    args.no_prompt = True
+    args.refresh = True
+    args.resume = False
+    recipe_list_path = (None if args.recipes else
+                        get_recipe_list_path(args.recipe_list))
+    template_path = (os.path.expanduser(args.pkginfo) if args.pkginfo else
+                     None)
+    catalog_paths = get_catalog_paths(args, munki_repo)
+    watcher = FileWatcher(
+        [path for path in [recipe_list_path, template_path] + catalog_paths
+         if path])
+    try:
+        while True:
+            print SEPARATOR
+            print "Watching for changes. Hit Ctrl-C to stop."
+            changed = watcher.wait()
+            affected = set()
+            # Nothing is replaced until everything changed has loaded,
+            # so a bad or half-written file leaves things as they were
+            # until it's fixed.
+            new_recipes = recipes
+            new_template = pkginfo_template
+            new_cat = production_cat
+            try:
+                if recipe_list_path in changed:
+                    new_recipes = get_recipes(recipe_list_path)
+                    if args.shard:
+                        new_recipes = get_shard(new_recipes, args.shard,
+                                                recipe_index)
+                if template_path in changed:
+                    new_template = get_pkginfo_template(template_path)
+                if changed.intersection(catalog_paths):
+                    with stats.phase("load_catalog"):
+                        new_cat = get_production_cat(
+                            args, munki_repo, get_catalog_names(
+                                new_recipes, args, recipe_index, answers))
+            except (Error, FoundationPlist.FoundationPlistException,
+                    EnvironmentError, SystemExit) as error:
+                print_error("Unable to load changes (%s); keeping the "
+                            "previous recipes, template and catalog." %
+                            error)
+                continue
+            affected.update(set(new_recipes) - set(recipes))
+            recipes = new_recipes
+            if new_template != pkginfo_template:
+                affected.update(recipes)
+            pkginfo_template = new_template
+            if new_cat is not production_cat:
+                names = get_changed_names(
+                    production_cat, new_cat, set(product_names.values()))
+                affected.update(recipe for recipe, name in
+                                product_names.items() if name in names)
+                production_cat = new_cat
+
+            affected = [recipe for recipe in recipes if recipe in affected]
+            print "%d override(s) affected by changes to %s." % (
+                len(affected), ", ".join(sorted(changed)))
+            if affected:
+                if override_index is not None:
+                    with stats.phase("index_overrides"):
+                        override_index = get_override_index(
+                            override_index.directory,
+                            use_cache=not args.no_cache)
+                with stats.phase("process_overrides"):
+                    process_overrides(affected, args, production_cat,
+                                      pkginfo_template, recipe_index, journal,
+                                      answers, stats, product_names,
+                                      json_output, override_index)
+    except KeyboardInterrupt:
+        print "Stopped watching."
+    finally:
+        watcher.close()
+
+
+def get_changed_names(old_cat, new_cat, names):
+    """Return those of names whose newest item differs between catalogs.
+
+    A name missing from both catalogs hasn't changed.
+    """
+    return set(name for name in names if
+               get_item_values(old_cat.get_newest(name)) !=
+               get_item_values(new_cat.get_newest(name)))
+
+
+def get_item_values(item):
+    """Return a comparable copy of a CatalogItem or pkginfo dict."""
+    return item.values if isinstance(item, CatalogItem) else dict(item)
+
+
+def process_overrides(recipes, args, production_cat, pkginfo_template,
+                      recipe_index=None, journal=None, answers=None,
+                      stats=None, product_names=None, json_output=None,
+                      override_index=None):
     """Start main processing loop.
 
+    Args:
+        json_output (file): If provided, each recipe's RecipeResult is
+            written to it as a line of JSON.
+        Others: As for iter_overrides.
+    """
+    for result in iter_overrides(recipes, args, production_cat,
+                                 pkginfo_template, recipe_index, journal,
+                                 answers, stats, product_names,
+                                 override_index):
+        if json_output is not None:
+            write_json_line(result, json_output)
+
+
+def iter_overrides(recipes, args, production_cat, pkginfo_template,
+                   recipe_index=None, journal=None, answers=None,
+                   stats=None, product_names=None, override_index=None):
+    """Create or refresh overrides, yielding a RecipeResult for each.
+
+    Recipes are processed in two phases. First, every recipe is
+    processed without prompting; overrides that need no answers are
+    written straight away. Then the questions for the remaining
+    overrides are asked all together, and they are written. Writes are
+    made by an OverrideWriter, so processing carries on meanwhile, and
+    results are yielded as writes finish; they are not necessarily in
+    recipe order. So that they don't land amid a later recipe's output,
+    the outcomes of writes are printed together at the end.
+
+    With args.quiet, nothing is printed while results are produced
+    (the caller's own output between them is unaffected), and no
+    questions are asked; errors are only reported in the results.
+
     Args:
         recipes (list of str): Recipe names/ids to override.
-        production_cat (Plist): Munki's 'production' catalog.
+        args: Options from get_options, or args parsed by
+            get_argument_parser.
+        production_cat (CatalogIndex): Index of Munki's 'production'
+            catalog.
         pkginfo_template (Plist): Template pkginfo settings to apply.
+        recipe_index (RecipeIndex): If provided, recipes it can't
+            resolve are skipped without running autopkg.
+        journal (RunJournal): If provided, each recipe's outcome is
+            recorded, and with args.resume, recipes it records as
+            finished are skipped.
+        answers (dict): Answers to questions, by recipe (see
+            update_override). Answers given interactively are added.
+        stats (RunStats): If provided, timings and counts are recorded
+            to it.
+        product_names (dict): If provided, the name of the catalog
+            item each updated override used (or if none was found, the
+            name it was looked up by) is stored, by recipe.
+        override_index (OverrideIndex): If provided, recipes it has an
+            override of are treated as such without running autopkg.
+
+    Yields:
+        RecipeResult
     """
+    quiet = getattr(args, "quiet", False)
+    if quiet and not args.no_prompt:
+        args = copy.copy(args)
+        args.no_prompt = True
+    results = _iter_override_results(
+        recipes, args, production_cat, pkginfo_template, recipe_index,
+        journal, answers, stats, product_names, override_index)
+    try:
+        while True:
+            with silenced(quiet):
+                try:
+                    result = next(results)
+                except StopIteration:
+                    return
+            yield result
+    finally:
+        with silenced(quiet):
+            results.close()
+
+
+@contextlib.contextmanager
+def silenced(quiet=True):
+    """Send what is printed in a block to os.devnull, if quiet."""
+    if not quiet:
+        yield
+        return
+    saved = sys.stdout, sys.stderr
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = sys.stderr = devnull
+        try:
+            yield
+        finally:
+            sys.stdout, sys.stderr = saved
+
+
+def _iter_override_results(recipes, args, production_cat, pkginfo_template,
+                           recipe_index, journal, answers, stats,
+                           product_names, override_index):
+    """Yield iter_overrides' results, printing as it goes."""
+    answers = answers if answers is not None else {}
+    stats = stats if stats is not None else RunStats()
+    writer = OverrideWriter()
+    # Recipe to (override, catalog pkginfo used) of queued writes.
+    pending = {}
+    # (message, is_error) outcomes of writes, printed at the end.
+    write_log = []
+    try:
+        for result in _iter_overrides(
+                recipes, args, production_cat, pkginfo_template,
+                recipe_index, journal, answers, stats, product_names, writer,
+                pending, write_log, override_index):
+            yield result
+    finally:
+        # Let queued writes finish, even when bailing.
+        written = record_writes(writer.close(), journal, stats, write_log)
+        if write_log:
+            print SEPARATOR
+            print_log(write_log)
+    for result in get_write_results(written, pending, stats):
+        yield result
+
+
+def _iter_overrides(recipes, args, production_cat, pkginfo_template,
+                    recipe_index, journal, answers, stats, product_names,
+                    writer, pending, write_log, override_index=None):
+    deferred = []
+    if args.resume and journal is not None:
+        finished = [recipe for recipe in recipes if
+                    journal.is_finished(recipe)]
+        if finished:
+            print "Skipping %d recipes finished by a previous run." % len(
+                finished)
+            stats.count("resumed", len(finished))
+        for recipe in finished:
+            yield get_result(recipe, "resumed", None, stats)
+        recipes = [recipe for recipe in recipes if
+                   not journal.is_finished(recipe)]
+
+    unresolved = get_unresolved_recipes(recipes, recipe_index)
+    if unresolved:
+        print_error("Unable to find recipe files for %d recipes: %s" %
+                    (len(unresolved), ", ".join(sorted(unresolved))))
+    overridable = [recipe for recipe in recipes if
+                   not get_exclusion_reason(recipe, recipe_index)]
+    existing = {}
+    # Recipe to other overrides of it, which are reported.
+    others = {}
+    if override_index is not None:
+        for recipe in overridable:
+            override_path = override_index.find(recipe, recipe_index)
+            if override_path:
+                existing[recipe] = override_path
+            others[recipe] = override_index.find_others(recipe,
+                                                        recipe_index)
+    # Statuses from a previous run, for finishing off its overrides.
+    previous = {}
+    if journal is not None:
+        previous = {recipe: journal.get_status(recipe) for recipe in recipes}
+        # autopkg may make overrides ahead of this loop (with --jobs),
+        # or be interrupted after making one, so they're journaled as
+        # 'making' before it runs.
+        for recipe in overridable:
+            if recipe not in existing:
+                journal.record(recipe, "making")
+    results = make_overrides(overridable, args.override_dir, args.jobs,
+                             recipe_index if args.in_process else None,
+                             existing)
     for recipe in recipes:
+        written = record_writes(writer.finished(), journal, stats,
+                                write_log)
+        for result in get_write_results(written, pending, stats):
+            yield result
         print SEPARATOR
 
-        if recipe in RECIPE_EXCLUSIONS:
-            print_error("Not overriding %s because it is in the list of "
-                        "exclusions." % recipe)
-            continue
-        if recipe.startswith("local"):
-            print_error("Not overriding %s because it _is_ an override." %
-                        recipe)
+        exclusion_reason = get_exclusion_reason(recipe, recipe_index)
+        if exclusion_reason:
+            print_error(exclusion_reason)
+            record(journal, stats, recipe, "excluded")
+            yield get_result(recipe, "excluded", None, stats)
             continue
 
-        override_path = make_override(recipe, args.override_dir)
-        if override_path is None:
+        with stats.phase("make_override", recipe):
+            status, override_path, override, log = next(results)
+        print_log(log)
+        for other in others.get(recipe, ()):
+            if other != override_path:
+                print "\tAnother override of %s, possibly a duplicate: %s" % (
+                    recipe, other)
+        # An override a previous run made, but was interrupted before
+        # updating, is finished off like a refresh.
+        interrupted = previous.get(recipe) in ("making", "started")
+        if status == "exists" and (args.refresh or interrupted):
+            print "\tRefreshing %s" % override_path
+            with stats.phase("read_override", recipe):
+                override = FoundationPlist.readPlist(override_path)
+        elif status != "created":
+            record(journal, stats, recipe, status, override_path)
+            yield get_result(recipe, status, override_path, stats,
+                             error=(get_log_error(log) if status != "exists"
+                                    else None))
             continue
+        else:
+            record(journal, stats, recipe, "started", override_path)
+            if override is None:
+                with stats.phase("read_override", recipe):
+                    override = FoundationPlist.readPlist(override_path)
+
+        previous_input = None
+        if status == "exists" and "Input_Original" in override:
+            previous_input = override["Input"]
+        else:
+            # Copy the override's Input section to Input_Original.
+            override["Input_Original"] = override["Input"]
+
+        # Questions for a human are deferred until every recipe has
+        # been processed, so the run doesn't stall waiting for answers.
+        current = {}
+        with stats.phase("update_override", recipe):
+            questions = update_override(
+                override, args, production_cat, pkginfo_template,
+                previous_input, answers.get(recipe, {}), stats, recipe,
+                current)
+        if product_names is not None:
+            product_names[recipe] = current.get("name") or get_product_name(
+                override, production_cat, answers.get(recipe))
+        if questions:
+            print "\tDeferring %d question(s) until the end of the run." % (
+                len(questions))
+            stats.count("deferred")
+            deferred.append((recipe, status, override_path, override,
+                             previous_input))
+        else:
+            pending[recipe] = (override, current)
+            writer.write(recipe, status, override, override_path)
 
-        # Copy just-generated override's Input section to Input_Original.
-        override = FoundationPlist.readPlist(override_path)
-        override["Input_Original"] = override["Input"]
-        override["Input"] = {}
-        override["Input"]["pkginfo"] = {}
+    if deferred:
+        print SEPARATOR
+        print "Please answer the questions for %d recipe(s)." % len(deferred)
+    for recipe, status, override_path, override, previous_input in deferred:
+        written = record_writes(writer.finished(), journal, stats,
+                                write_log)
+        for result in get_write_results(written, pending, stats):
+            yield result
+        print SEPARATOR
+        print recipe
+        recipe_answers = answers.setdefault(recipe, {})
+        while True:
+            current = {}
+            with stats.phase("update_override", recipe):
+                questions = update_override(
+                    override, args, production_cat, pkginfo_template,
+                    previous_input, recipe_answers, stats, recipe, current)
+            if not questions:
+                break
+            stats.count("questions", len(questions))
+            with stats.phase("prompt", recipe):
+                ask_questions(questions, recipe_answers)
+        if product_names is not None:
+            product_names[recipe] = current.get("name") or get_product_name(
+                override, production_cat, recipe_answers)
+        pending[recipe] = (override, current)
+        writer.write(recipe, status, override, override_path)
+
+
+def get_write_results(written, pending, stats):
+    """Return RecipeResults for record_writes' results."""
+    results = []
+    for recipe, status, override_path, error in written:
+        override, current = pending.pop(recipe, (None, None))
+        results.append(get_result(recipe, status, override_path, stats,
+                                  override, current, error))
+    return results
+
+
+def get_result(recipe, status, override_path, stats, override=None,
+               current=None, error=None):
+    """Return a RecipeResult for a recipe that is done with."""
+    pkginfo = None
+    if override is not None:
+        pkginfo = dict(override["Input"].get("pkginfo", {}))
+    current = current or {}
+    return RecipeResult(
+        recipe, status, override_path, current.get("name"),
+        current.get("version"), pkginfo,
+        dict(stats.get_recipe(recipe)["phases"]), error)
+
+
+def get_log_error(log):
+    """Return the last error message in a make-override log, or None."""
+    errors = [message.strip() for message, is_error in log if is_error]
+    return errors[-1] if errors else None
+
+
+def write_json_line(result, output):
+    """Write a RecipeResult to output as a line of JSON."""
+    # Plist dates and data aren't JSON types.
+    output.write(json.dumps(result._asdict(), default=str) + "\n")
+    output.flush()
+
+
+def update_override(override, args, production_cat, pkginfo_template,
+                    previous_input=None, answers=None, stats=None,
+                    recipe=None, current=None):
+    """(Re)build an override's 'Input' without prompting.
 
+    Args:
+        override (Plist): Override with its 'Input_Original' set.
+        args: ArgumentParser args.
+        production_cat (CatalogIndex): Catalog to take values from.
+        pkginfo_template (PkginfoTemplate or dict): Template pkginfo
+            settings to apply.
+        previous_input (dict): Previous 'Input' of a refreshed override.
+        answers (dict): Answers to this recipe's questions, with
+            optional 'name', 'subdir' and 'keys' (a dict) keys.
+        stats (RunStats): If provided, catalog lookup time is recorded.
+        recipe (str): Recipe name to record stats under.
+        current (dict): If provided, the 'name' and 'version' of the
+            catalog pkginfo used are stored in it.
+
+    Returns:
+        list of (str kind, key, str prompt) questions that need answers
+        before the override is complete. key is the pkginfo key for
+        'keys' questions, the list of suggested names for 'name'
+        questions, and None otherwise. Until the product
+        name is known, only the name is asked about.
+    """
+    questions = []
+    override["Input"] = {}
+    override["Input"]["pkginfo"] = {}
+
+    stats = stats if stats is not None else RunStats()
+    with stats.phase("lookup", recipe):
         current_version = get_current_production_version(
-            production_cat, override, args)
-        apply_current_or_orig_values(override, current_version, args)
+            production_cat, override, args, answers, questions)
+    if questions:
+        return questions
+    if current is not None and current_version:
+        current["name"] = current_version["name"]
+        current["version"] = current_version["version"]
+    apply_current_or_orig_values(override, current_version, args,
+                                 previous_input, answers, questions)
+
+    if not args.suppress_subdir:
+        copy_package_path_to_input(override, current_version, args, answers,
+                                   questions)
+
+    if pkginfo_template:
+        apply_pkginfo_template(override, pkginfo_template, recipe)
 
-        if not args.suppress_subdir:
-            copy_package_path_to_input(override, current_version, args)
+    return questions
 
-        if pkginfo_template:
-            apply_pkginfo_template(override, pkginfo_template)
 
-        FoundationPlist.writePlist(override, override_path)
+def ask_questions(questions, answers):
+    """Interactively ask questions, storing the replies in answers.
+
+    A number answering a name question picks that suggestion.
+    """
+    for kind, key, prompt in questions:
+        choice = raw_input(prompt)
+        if kind == "name" and choice.isdigit() and key and (
+                1 <= int(choice) <= len(key)):
+            answers[kind] = key[int(choice) - 1]
+        elif kind == "keys":
+            answers.setdefault("keys", {})[key] = choice
+        else:
+            answers[kind] = choice
+
+
+def record_writes(results, journal, stats, log):
+    """Record the results of OverrideWriter writes.
+
+    Args:
+        results (list): As returned by OverrideWriter.finished.
+        journal (RunJournal): Journal, or None.
+        stats (RunStats): Stats to record to.
+        log (list): (message, is_error) entries for the outcomes are
+            appended here, for print_log.
+
+    Returns:
+        list of (recipe, final status, override path, error message or
+        None).
+    """
+    written = []
+    for recipe, status, override_path, result, seconds in results:
+        stats.add_time("write_override", seconds, recipe)
+        error = None
+        if result == "written":
+            if status == "exists":
+                log.append(("Updated %s" % override_path, False))
+        elif result == "unchanged":
+            log.append(("No changes to %s" % override_path, False))
+        else:
+            log.append(("Unable to write %s: %s" % (override_path, result),
+                        True))
+            result, error = "failed", result
+        record(journal, stats, recipe, result, override_path)
+        written.append((recipe, result, override_path, error))
+    return written
+
+
+def record(journal, stats, recipe, status, path=None):
+    """Record a recipe's status in stats, and journal if there is one."""
+    stats.set_status(recipe, status)
+    if journal is not None:
+        journal.record(recipe, status, path)
 
 
 def get_argument_parser():
     """Create our argument parser."""
+    import argparse
     description = (
         "Create an override for each recipe listed in an Autopkg recipe-list. "
         "or a supplied list of recipe identifiers. (Defaults to current "
@@ -244,15 +2061,31 @@ def get_argument_parser():
     arg_help = ("Input metadata key names (may specify multiple values) to "
                 "copy from newest production version to 'Input'. Defaults to: "
                 "%(default)s")
-    parser.add_argument("-k", "--keys", help=arg_help, nargs="+",
-                        default=METADATA)
+    parser.add_argument("-k", "--keys", help=arg_help, nargs="+")
     arg_help = ("Path to a plist file defining override values to enforce. "
                 "This plist should have a top-level dict element named "
-                "'pkginfo'. ")
+                "'pkginfo', and/or a 'rules' array of dicts, each with "
+                "'match' (field: value) and/or 'match_regex' (field: "
+                "regex) conditions, and the 'pkginfo' values to enforce "
+                "when they all hold. Fields are the override's pkginfo "
+                "values, 'recipe' and 'parent_recipe'. ")
     parser.add_argument("-p", "--pkginfo", help=arg_help)
-    arg_help = ("Name of Munki catalog from which to search current pkginfo "
-                "values. (Defaults to '%(default)s)'")
-    parser.add_argument("-c", "--catalog", help=arg_help, default="production")
+    arg_help = ("Name(s) of Munki catalogs from which to search current "
+                "pkginfo values. With several catalogs, each product's "
+                "values come from the first catalog, in the order given, "
+                "that has it. (Defaults to '%(default)s')")
+    parser.add_argument("-c", "--catalog", help=arg_help, nargs="+")
+    arg_help = ("Path or HTTP(S) URL of the Munki repo. With a URL, catalogs "
+                "are downloaded to, and revalidated against, a local cache. "
+                "(Defaults to autopkg's MUNKI_REPO)")
+    parser.add_argument("--munki-repo", help=arg_help)
+    arg_help = ("Build the lookup index from the pkginfo files in the Munki "
+                "repo's pkgsinfo directory, rather than from its catalogs, "
+                "for when the catalogs are stale or missing. Only pkginfos "
+                "in the --catalog catalogs are used. Files are only re-read "
+                "when they change.")
+    parser.add_argument("--from-pkgsinfo", help=arg_help,
+                        action="store_true")
     arg_help = ("Skip copying subdirectory information from existing items. "
                 " Most Munki recipes provide access to the MunkiImporter "
                 "`repo_subdirectory` argument in the Input section as "
@@ -267,29 +2100,815 @@ def get_argument_parser():
                 "in the most recent production version of a product, this "
                 "option instructs easy_rider to just enter a blank string.")
     parser.add_argument("--no_prompt", help=arg_help, action="store_true")
+    arg_help = ("With --no_prompt, when a product's name isn't in the "
+                "catalog, use the closest catalog name if its similarity "
+                "score (0 to 1) is at least this. Use a value over 1 to "
+                "never guess. (Defaults to %(default)s)")
+    parser.add_argument("--match-threshold", help=arg_help, type=float)
     arg_help = ("Instead of using current production value for "
                 "repo_subdirectory, either prompt for input (no value) or "
                 "use the value of a pkginfo key (e.g. 'developer' or "
                 "'category').")
     parser.add_argument("--specify_subdir", help=arg_help, nargs="?",
-                        default="", const="<PROMPT>")
+                        const="<PROMPT>")
+    arg_help = ("Don't read or write the on-disk catalog index cache in "
+                "%s." % CACHE_DIR)
+    parser.add_argument("--no-cache", help=arg_help, action="store_true")
+    arg_help = ("Re-parse the catalog and replace its cached index, even if "
+                "the catalog is unchanged.")
+    parser.add_argument("--rebuild-cache", help=arg_help,
+                        action="store_true")
+    arg_help = ("Look up the catalog in a memory-mapped snapshot at this "
+                "path, writing it first if it's missing or stale. Runs on "
+                "the same machine (e.g. each --shard) share one copy of the "
+                "snapshot rather than each loading the catalog.")
+    parser.add_argument("--snapshot", help=arg_help)
+    arg_help = ("Build overrides in-process from the recipe files found in "
+                "the autopkg recipe search dirs, rather than running autopkg "
+                "make-override for each recipe. Recipes that can't be loaded "
+                "(e.g. YAML recipes, or ones with missing parents) still use "
+                "autopkg. Overrides made this way have no "
+                "ParentRecipeTrustInfo; run 'autopkg update-trust-info' on "
+                "them afterwards if you use recipe trust.")
+    parser.add_argument("--in-process", help=arg_help, action="store_true")
+    arg_help = ("Path to a plist of answers to the questions easy_rider "
+                "would otherwise ask, keyed by recipe. Each recipe's dict "
+                "may have a 'name' (Munki name to look up; empty to skip "
+                "lookup), a 'subdir' and a 'keys' dict of pkginfo values.")
+    parser.add_argument("--answers", help=arg_help)
+    arg_help = ("Path to save all answers, including any given "
+                "interactively, to, for use with --answers.")
+    parser.add_argument("--save-answers", help=arg_help)
+    arg_help = ("Path to the run journal, which records what happened to "
+                "each recipe. (Defaults to a file, per override dir and "
+                "--shard, in %s)" % CACHE_DIR)
+    parser.add_argument("--journal", help=arg_help)
+    arg_help = ("Skip recipes the journal records as finished by the last "
+                "run, e.g. after bailing out of it, and finish updating "
+                "overrides it made but didn't get to update.")
+    parser.add_argument("--resume", help=arg_help, action="store_true")
+    arg_help = ("Instead of skipping recipes that already have an override, "
+                "re-sync the override's 'Input' from the catalog, keeping "
+                "its 'Input_Original' and any previous values that have no "
+                "current value. Overrides are only rewritten if their "
+                "content changes.")
+    parser.add_argument("--refresh", help=arg_help, action="store_true")
+    arg_help = ("Write a JSON report of the wall time and count of each phase "
+                "of the run, per recipe timings and statuses, and counts of "
+                "timeouts, skips and questions to this path.")
+    parser.add_argument("--stats", help=arg_help)
+    arg_help = ("Write a line of JSON to stdout for each recipe when it's "
+                "done, with its status, override path, the catalog name "
+                "and version used, the override's pkginfo values and "
+                "timings. Other output goes to stderr.")
+    parser.add_argument("--json-lines", help=arg_help, action="store_true")
+    arg_help = ("Profile the run with cProfile. Stats are saved to the path "
+                "given, for use with pstats, or, with no path, the top "
+                "functions by cumulative time are printed.")
+    parser.add_argument("--profile", help=arg_help, nargs="?", const="-")
+    arg_help = ("After processing, keep running, and refresh the overrides "
+                "affected whenever the recipe list, catalogs (or pkgsinfo) "
+                "or pkginfo template change. Implies --refresh; refreshes "
+                "never prompt.")
+    parser.add_argument("--watch", help=arg_help, action="store_true")
+    arg_help = ("Process only shard I of N (e.g. '2/4') of the recipes, to "
+                "split a run across machines. Recipes are partitioned by a "
+                "hash of their name, after duplicates are removed; "
+                "excluded recipes are only reported by shard 1. The catalog "
+                "index only keeps the shard's products.")
+    parser.add_argument("--shard", help=arg_help, type=get_shard_arg,
+                        metavar="I/N")
+    arg_help = ("Instead of processing recipes, merge the journals and "
+                "--stats reports of sharded runs, writing the results to "
+                "--journal and --stats, and print a summary.")
+    parser.add_argument("--merge", help=arg_help, nargs="+",
+                        metavar="REPORT")
+    arg_help = ("Number of autopkg make-override processes to run at once. "
+                "Overrides are still updated and written in recipe order. "
+                "(Defaults to %(default)s)")
+    parser.add_argument("-j", "--jobs", help=arg_help, type=int)
+    arg_help = ("Don't print progress or results, only fatal errors. "
+                "Implies --no_prompt, as questions can't be asked. Results "
+                "are still written with --json-lines.")
+    parser.add_argument("-q", "--quiet", help=arg_help, action="store_true")
+    parser.set_defaults(**copy.deepcopy(DEFAULT_OPTIONS))
     return parser
 
 
+class Options(object):
+    """Options, by attribute, like those get_argument_parser parses."""
+
+    def __init__(self, **options):
+        self.__dict__.update(options)
+
+    def __repr__(self):
+        return "Options(%s)" % ", ".join(
+            "%s=%r" % item for item in sorted(self.__dict__.items()))
+
+
+def get_options(**options):
+    """Return options for iter_overrides, without parsing a command line.
+
+    This is for embedding easy_rider without argparse. Options not
+    given take their command-line defaults (DEFAULT_OPTIONS). Those
+    iter_overrides uses are: in_process, jobs, keys, match_threshold,
+    no_prompt, override_dir, quiet, refresh, resume, specify_subdir and
+    suppress_subdir; they mean the same as the matching command-line
+    options (e.g. no_prompt is --no_prompt).
+
+    Args:
+        options: Option values by attribute name, e.g.
+            override_dir="~/overrides", no_prompt=True.
+
+    Raises:
+        TypeError: If an option isn't known.
+    """
+    unknown = set(options) - set(DEFAULT_OPTIONS)
+    if unknown:
+        raise TypeError("Unknown option(s): %s" % ", ".join(sorted(unknown)))
+    values = copy.deepcopy(DEFAULT_OPTIONS)
+    values.update(options)
+    return Options(**values)
+
+
+def get_shard_arg(value):
+    """Parse a --shard argument of the form 'I/N'."""
+    import argparse
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "'%s' isn't of the form I/N, e.g. 1/4" % value)
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(
+            "Shard %d/%d doesn't exist; shards are numbered from 1 to %d." %
+            (index, count, count))
+    return index, count
+
+
 def get_pkginfo_template(pkginfo_template_path):
-    """Return the pkginfo top-level key from a plist file."""
-    pkginfo_template = FoundationPlist.readPlist(
-        os.path.expanduser(pkginfo_template_path)).get("pkginfo")
-    if not pkginfo_template:
+    """Return a compiled PkginfoTemplate from a plist file.
+
+    The plist's top-level 'pkginfo' dict is enforced on every override,
+    and its 'rules' array on matching ones (see PkginfoTemplate).
+    """
+    template = FoundationPlist.readPlist(
+        os.path.expanduser(pkginfo_template_path))
+    if not hasattr(template, "get"):
         sys.exit("Pkginfo template format incorrect!. Quitting.")
-    return pkginfo_template
+    pkginfo = template.get("pkginfo")
+    rules = template.get("rules")
+    if not (pkginfo or rules):
+        sys.exit("Pkginfo template format incorrect!. Quitting.")
+    try:
+        return PkginfoTemplate(pkginfo, rules or ())
+    except Error as error:
+        sys.exit("Pkginfo template format incorrect: %s Quitting." % error)
 
 
-def get_recipes(recipe_list_path):
-    """Return a list of recipes read from a recipe list."""
+def get_production_cat(args, munki_repo, names=None):
+    """Return the CatalogIndex for args' catalogs, however it's built.
+
+    Args:
+        args: ArgumentParser args.
+        munki_repo (str): Path to the Munki repo.
+        names (iterable of str): If provided, only these names are
+            kept in the index, unless any of them isn't in it: then
+            the whole index is kept, for suggesting and matching names.
+
+    Returns:
+        CatalogIndex, or with args.snapshot and no names, a
+        CatalogSnapshot.
+    """
+    if args.from_pkgsinfo:
+        source_paths = get_catalog_paths(args, munki_repo)
+        build = lambda: get_pkgsinfo_index(
+            munki_repo, args.catalog, args.keys, use_cache=not args.no_cache,
+            rebuild_cache=args.rebuild_cache)
+    else:
+        if is_url(munki_repo):
+            repo = HTTPRepo(munki_repo)
+            try:
+                source_paths = [repo.fetch("catalogs/%s" % catalog) for
+                                catalog in args.catalog]
+            finally:
+                repo.close()
+        else:
+            source_paths = get_catalog_paths(args, munki_repo)
+        build = lambda: get_catalog_indexes(
+            source_paths, args.keys, use_cache=not args.no_cache,
+            rebuild_cache=args.rebuild_cache)
+    if args.snapshot:
+        index = get_catalog_snapshot(
+            os.path.expanduser(args.snapshot), source_paths,
+            get_record_keys(args.keys), args.catalog, build,
+            args.rebuild_cache)
+    else:
+        index = build()
+    if names is not None and all(name in index for name in names):
+        return index.subset(names)
+    return index
+
+
+def get_catalog_snapshot(path, source_paths, keys, catalogs, build,
+                         rebuild=False):
+    """Return the CatalogSnapshot at path, writing it first if stale.
+
+    The snapshot is stale if the mtime or size of any source file, the
+    keys, or the catalogs have changed since it was written.
+
+    Args:
+        path (str): Path of the snapshot.
+        source_paths (list of str): Catalogs, or pkgsinfo dir, the
+            index is built from.
+        keys (tuple of str): Keys the index keeps.
+        catalogs (list of str): Catalog names, in order of precedence.
+        build (callable): Returns the CatalogIndex to snapshot.
+        rebuild (bool): Whether to write the snapshot even if it's up
+            to date.
+
+    Returns:
+        CatalogSnapshot
+    """
+    signature = hashlib.sha1(cPickle.dumps(
+        ([(os.path.realpath(source_path), get_signature(source_path)) for
+          source_path in source_paths], tuple(keys), tuple(catalogs)),
+        cPickle.HIGHEST_PROTOCOL)).digest()
+    if not rebuild and os.path.exists(path):
+        try:
+            snapshot = CatalogSnapshot(path)
+        except Error as error:
+            print_error(str(error))
+        else:
+            if snapshot.signature == signature:
+                return snapshot
+            snapshot.close()
+    CatalogSnapshot.write(path, build(), keys, signature)
+    return CatalogSnapshot(path)
+
+
+def is_url(path):
+    return path.startswith(("http://", "https://"))
+
+
+def get_catalog_paths(args, munki_repo):
+    """Return the paths get_production_cat reads, for watching."""
+    if args.from_pkgsinfo:
+        return [os.path.join(munki_repo, "pkgsinfo")]
+    return [os.path.join(munki_repo, "catalogs/%s" % catalog) for catalog in
+            args.catalog]
+
+
+def get_catalog_indexes(catalog_paths, keys, use_cache=True,
+                        rebuild_cache=False):
+    """Return one CatalogIndex merged from several catalogs.
+
+    Cached indexes are used where possible (see get_catalog_index). If
+    several catalogs need parsing, they are parsed concurrently, in
+    separate processes. The indexes are merged with
+    CatalogIndex.merge, so earlier catalogs take precedence.
+
+    Args:
+        catalog_paths (list of str): Paths to Munki catalogs, in order
+            of precedence.
+        keys (iterable of str): pkginfo keys to keep in addition to
+            CATALOG_KEYS.
+        use_cache (bool): Whether to read and write the cache at all.
+        rebuild_cache (bool): Whether to ignore, and replace, any
+            cached indexes.
+
+    Returns:
+        CatalogIndex
+    """
+    import multiprocessing
+    keys = tuple(keys)
+    indexes = [get_cached_catalog_index(catalog_path, keys) if use_cache and
+               not rebuild_cache else None for catalog_path in catalog_paths]
+    jobs = [(catalog_path, keys, use_cache) for catalog_path, index in
+            zip(catalog_paths, indexes) if index is None]
+    workers = min(len(jobs), multiprocessing.cpu_count())
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            built = pool.map_async(_build_catalog_index, jobs).get(
+                sys.maxint)
+        finally:
+            pool.terminate()
+    else:
+        built = [_build_catalog_index(job) for job in jobs]
+
+    built = iter(built)
+    indexes = [index if index is not None else next(built) for index in
+               indexes]
+    return indexes[0] if len(indexes) == 1 else CatalogIndex.merge(indexes)
+
+
+def get_catalog_index(catalog_path, keys, use_cache=True,
+                      rebuild_cache=False):
+    """Return a CatalogIndex for a catalog, using the cache if possible.
+
+    A cached index is used if it was built with the same keys from a
+    catalog with the same size and either the same mtime or the same
+    content hash.
+
+    Args:
+        catalog_path (str): Path to a Munki catalog.
+        keys (iterable of str): pkginfo keys to keep in addition to
+            CATALOG_KEYS.
+        use_cache (bool): Whether to read and write the cache at all.
+        rebuild_cache (bool): Whether to ignore, and replace, any
+            cached index.
+
+    Returns:
+        CatalogIndex
+    """
+    index = None
+    if use_cache and not rebuild_cache:
+        index = get_cached_catalog_index(catalog_path, keys)
+    if index is None:
+        index = build_catalog_index(catalog_path, keys, use_cache)
+    return index
+
+
+def get_cached_catalog_index(catalog_path, keys):
+    """Return a catalog's cached CatalogIndex, or None if it's stale."""
+    cache_name = get_catalog_cache_name(catalog_path)
+    stat = os.stat(catalog_path)
+    cached = read_cache(cache_name)
+    if (not cached or cached["keys"] != tuple(keys) or
+            cached["size"] != stat.st_size):
+        return None
+    if cached["mtime"] != stat.st_mtime:
+        if cached["hash"] != hash_file(catalog_path):
+            return None
+        cached["mtime"] = stat.st_mtime
+        write_cache(cache_name, cached)
+    return cached["index"]
+
+
+def build_catalog_index(catalog_path, keys, use_cache=True):
+    """Parse a catalog into a CatalogIndex, and cache it if use_cache."""
+    stat = os.stat(catalog_path)
+    index = CatalogIndex(load_catalog(catalog_path, keys))
+    if use_cache:
+        write_cache(get_catalog_cache_name(catalog_path),
+                    {"mtime": stat.st_mtime, "size": stat.st_size,
+                     "keys": tuple(keys), "hash": hash_file(catalog_path),
+                     "index": index})
+    return index
+
+
+def _build_catalog_index(job):
+    """Call build_catalog_index with a tuple of args, for Pool.map."""
+    return build_catalog_index(*job)
+
+
+def get_catalog_cache_name(catalog_path):
+    return "catalog-%s" % hashlib.sha1(
+        os.path.realpath(catalog_path)).hexdigest()
+
+
+def get_override_dir(autopkg_prefs):
+    """Return the directory autopkg make-override saves overrides to."""
+    override_dirs = autopkg_prefs.get("RECIPE_OVERRIDE_DIRS",
+                                      DEFAULT_OVERRIDE_DIR)
+    if not isinstance(override_dirs, basestring):
+        override_dirs = override_dirs[0] if override_dirs else (
+            DEFAULT_OVERRIDE_DIR)
+    return os.path.expanduser(override_dirs)
+
+
+def get_recipe_search_dirs(autopkg_prefs):
+    """Return the directories autopkg searches for recipes."""
+    search_dirs = list(autopkg_prefs.get(
+        "RECIPE_SEARCH_DIRS", DEFAULT_RECIPE_SEARCH_DIRS))
+    search_dirs.extend(autopkg_prefs.get("RECIPE_REPOS", {}).keys())
+    result = []
+    for search_dir in search_dirs:
+        search_dir = os.path.abspath(os.path.expanduser(search_dir))
+        if search_dir not in result:
+            result.append(search_dir)
+    return result
+
+
+def get_recipe_index(search_dirs, use_cache=True, rebuild_cache=False):
+    """Return a RecipeIndex of search_dirs, using the cache if possible.
+
+    A cached index is used if the mtimes of every directory it was
+    built from are unchanged; adding, removing or renaming a recipe
+    changes its directory's mtime.
+
+    Args:
+        search_dirs (list of str): Directories to search for recipes.
+        use_cache (bool): Whether to read and write the cache at all.
+        rebuild_cache (bool): Whether to ignore, and replace, any
+            cached index.
+
+    Returns:
+        RecipeIndex
+    """
+    cache_name = "recipes-%s" % hashlib.sha1(
+        "\0".join(search_dirs)).hexdigest()
+    cached = (read_cache(cache_name) if use_cache and not rebuild_cache else
+              None)
+    if cached and all(get_mtime(path) == mtime for path, mtime in
+                      cached["mtimes"].items()):
+        return cached["index"]
+
+    names = {}
+    identifiers = {}
+    mtimes = {}
+    # Like autopkg, look in each search dir and its immediate subdirs.
+    for search_dir in search_dirs:
+        if not os.path.isdir(search_dir):
+            mtimes[search_dir] = None
+            continue
+        dirpaths = [search_dir] + sorted(
+            os.path.join(search_dir, dirname) for dirname in
+            os.listdir(search_dir) if not dirname.startswith(".") and
+            os.path.isdir(os.path.join(search_dir, dirname)))
+        for dirpath in dirpaths:
+            mtimes[dirpath] = get_mtime(dirpath)
+            for filename in sorted(os.listdir(dirpath)):
+                extension = get_recipe_extension(filename)
+                if not extension:
+                    continue
+                path = os.path.join(dirpath, filename)
+                names.setdefault(filename[:-len(extension)], path)
+                identifier = get_recipe_identifier(path)
+                if identifier:
+                    identifiers.setdefault(identifier, path)
+
+    index = RecipeIndex(names, identifiers)
+    if use_cache:
+        write_cache(cache_name, {"mtimes": mtimes, "index": index})
+    return index
+
+
+def get_recipe_extension(filename):
+    """Return the recipe extension of filename, or None."""
+    for extension in RECIPE_EXTENSIONS:
+        if filename.endswith(extension):
+            return extension
+    return None
+
+
+def get_recipe_identifier(path):
+    """Return a recipe file's Identifier, or None."""
+    return get_recipe_identifiers(path)[0]
+
+
+def get_recipe_identifiers(path):
+    """Return a recipe file's (Identifier, ParentRecipe), or Nones."""
+    if path.endswith(".yaml"):
+        try:
+            with open(path) as recipe_file:
+                data = recipe_file.read()
+        except (IOError, OSError):
+            return None, None
+        return tuple(match.group(1) if match else None for match in
+                     (YAML_IDENTIFIER_RE.search(data),
+                      YAML_PARENT_RECIPE_RE.search(data)))
+    try:
+        recipe = FoundationPlist.readPlist(path)
+        return recipe.get("Identifier"), recipe.get("ParentRecipe")
+    except (FoundationPlist.FoundationPlistException, AttributeError):
+        return None, None
+
+
+def get_override_index(override_dir, use_cache=True, rebuild_cache=False):
+    """Return an OverrideIndex of override_dir, using the cache if possible.
+
+    A cached index is used if the directory's mtime is unchanged, so
+    overrides added, removed or replaced (as OverrideWriter does) are
+    seen; edits in place aren't.
+
+    Args:
+        override_dir (str): The override dir.
+        use_cache (bool): Whether to read and write the cache at all.
+        rebuild_cache (bool): Whether to ignore, and replace, any
+            cached index.
+
+    Returns:
+        OverrideIndex
+    """
+    override_dir = os.path.realpath(os.path.expanduser(override_dir))
+    cache_name = "overrides-%s" % hashlib.sha1(override_dir).hexdigest()
+    mtime = get_mtime(override_dir)
+    cached = (read_cache(cache_name) if use_cache and not rebuild_cache else
+              None)
+    if cached and cached["mtime"] == mtime:
+        return cached["index"]
+
+    names = {}
+    identifiers = {}
+    parents = {}
+    if mtime is not None:
+        for filename in sorted(os.listdir(override_dir)):
+            extension = get_recipe_extension(filename)
+            if not extension or filename.startswith("."):
+                continue
+            path = os.path.join(override_dir, filename)
+            names[filename[:-len(extension)]] = path
+            identifier, parent = get_recipe_identifiers(path)
+            if identifier:
+                identifiers.setdefault(identifier, path)
+            if parent:
+                parents.setdefault(parent, []).append(path)
+
+    index = OverrideIndex(override_dir, names, identifiers, parents)
+    if use_cache:
+        write_cache(cache_name, {"mtime": mtime, "index": index})
+    return index
+
+
+def get_mtime(path):
+    """Return path's mtime, or None if it doesn't exist."""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def monotonic():
+    """Return seconds since a fixed point, for measuring timeouts.
+
+    On POSIX, this is os.times()'s elapsed real time, which counts
+    clock ticks (usually 10ms) from an arbitrary point in the past, so
+    it doesn't jump when the system clock is set, as time.time does.
+    Elsewhere, os.times() doesn't provide it, and time.time is used.
+    """
+    if os.name == "posix":
+        return os.times()[4]
+    return time.time()
+
+
+def get_signature(path):
+    """Return a value that changes when path, or a file in it, changes."""
+    if os.path.isdir(path):
+        return tuple(sorted(
+            (os.path.join(dirpath, filename),) +
+            get_signature(os.path.join(dirpath, filename))
+            for dirpath, _, filenames in os.walk(path)
+            for filename in filenames))
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return ()
+    return (stat.st_mtime, stat.st_size)
+
+
+def get_journal_path(override_dir, shard=None):
+    """Return the default journal path for an override dir (and shard).
+
+    Each shard has its own journal, so concurrent shards on one machine
+    don't truncate, or resume from, each other's.
+    """
+    key = os.path.realpath(os.path.expanduser(override_dir or
+                                              DEFAULT_OVERRIDE_DIR))
+    suffix = "-shard-%d-of-%d" % shard if shard else ""
+    return os.path.join(CACHE_DIR, "journal-%s%s.jsonl" %
+                        (hashlib.sha1(key).hexdigest(), suffix))
+
+
+def read_journal(path):
+    """Return the last journal entry for each recipe in a journal."""
+    entries = {}
+    try:
+        with open(path) as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Likely a line cut short by a crash.
+                    continue
+                entries[entry["recipe"]] = entry
+    except (IOError, OSError):
+        pass
+    return entries
+
+
+def read_cache(name):
+    """Return the data cached under name, or None."""
+    try:
+        with open(os.path.join(CACHE_DIR, name + ".pickle"), "rb") as cache:
+            cached = cPickle.load(cache)
+    except (IOError, OSError, EOFError, cPickle.UnpicklingError,
+            AttributeError, ImportError, IndexError, TypeError, ValueError):
+        return None
+    if not isinstance(cached, dict) or cached.get("version") != CACHE_VERSION:
+        return None
+    return cached["data"]
+
+
+def write_cache(name, data):
+    """Atomically cache data under name; failures are not fatal."""
+    temp_path = None
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        handle, temp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix=".")
+        with os.fdopen(handle, "wb") as cache:
+            cPickle.dump({"version": CACHE_VERSION, "data": data}, cache,
+                         cPickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, os.path.join(CACHE_DIR, name + ".pickle"))
+    except (IOError, OSError, cPickle.PicklingError) as error:
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+        print_error("Unable to write cache %s: %s" % (name, error))
+
+
+def read_file(path):
+    with open(path, "rb") as handle:
+        return handle.read()
+
+
+def write_temp_file(path, data):
+    """Write and sync data to a temporary file beside path.
+
+    Returns:
+        str: The temporary file's path, for renaming over path.
+    """
+    handle, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix=".")
+    try:
+        with os.fdopen(handle, "wb") as temp_file:
+            temp_file.write(data)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_path, 0666 & ~umask)
+    except EnvironmentError:
+        os.remove(temp_path)
+        raise
+    return temp_path
+
+
+def fsync_directory(directory):
+    """Sync a directory, so renames in it survive a crash."""
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    except OSError as error:
+        # Some filesystems can't sync directories.
+        if error.errno not in (errno.EINVAL, errno.ENOTSUP):
+            raise
+    finally:
+        os.close(fd)
+
+
+def hash_file(path):
+    """Return the hex SHA-1 digest of a file's contents."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(1024 * 1024), ""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_catalog(catalog_path, keys):
+    """Stream a Munki catalog, keeping only the values easy_rider uses.
+
+    Args:
+        catalog_path (str): Path to a Munki catalog.
+        keys (iterable of str): pkginfo keys to keep in addition to
+            CATALOG_KEYS.
+
+    Returns:
+        list of CatalogItem.
+    """
+    keys = get_record_keys(keys)
+    positions = {key: position for position, key in enumerate(keys)}
+    return [CatalogItem(positions, get_record_values(item, keys)) for item in
+            FoundationPlist.iterPlistArray(catalog_path, keys)]
+
+
+def get_record_keys(keys):
+    """Return the keys CatalogItems keep: CATALOG_KEYS, then keys."""
+    return tuple(CATALOG_KEYS) + tuple(
+        key for key in keys if key not in CATALOG_KEYS)
+
+
+def get_record_values(item, keys):
+    """Return a tuple of a pkginfo's values for a CatalogItem."""
+    values = []
+    for key in keys:
+        value = item.get(key)
+        # Names, categories and developers repeat across many items;
+        # interning lets their records share one copy.
+        if isinstance(value, str):
+            value = intern(value)
+        values.append(value)
+    return tuple(values)
+
+
+def get_pkgsinfo_index(munki_repo, catalogs, keys, use_cache=True,
+                       rebuild_cache=False):
+    """Build a CatalogIndex straight from a Munki repo's pkgsinfo.
+
+    This is for when the catalogs may be stale or missing. pkginfo files
+    (those with PKGINFO_EXTENSIONS) are parsed across a process pool, and
+    only those in one of catalogs are indexed. The values read from
+    each file are cached by path, mtime and size, so later runs only
+    re-read changed files. As with get_catalog_indexes, earlier catalogs
+    take precedence.
+
+    Args:
+        munki_repo (str): Path to the Munki repo.
+        catalogs (list of str): Catalog names, in order of precedence.
+        keys (iterable of str): pkginfo keys to keep in addition to
+            CATALOG_KEYS.
+        use_cache (bool): Whether to read and write the cache at all.
+        rebuild_cache (bool): Whether to ignore, and replace, any
+            cached values.
+
+    Returns:
+        CatalogIndex
+    """
+    import multiprocessing
+    pkgsinfo = os.path.realpath(os.path.join(munki_repo, "pkgsinfo"))
+    keys = get_record_keys(keys)
+    cache_name = "pkgsinfo-%s" % hashlib.sha1(pkgsinfo).hexdigest()
+    cached = (read_cache(cache_name) if use_cache and not rebuild_cache else
+              None)
+    cached_files = cached["files"] if cached and cached["keys"] == keys else {}
+
+    files = {}
+    changed = []
+    for dirpath, dirnames, filenames in os.walk(pkgsinfo):
+        dirnames[:] = [dirname for dirname in dirnames if
+                       not dirname.startswith(".")]
+        for filename in filenames:
+            if (filename.startswith(".") or
+                    not filename.endswith(PKGINFO_EXTENSIONS)):
+                continue
+            path = os.path.join(dirpath, filename)
+            stat = os.stat(path)
+            entry = cached_files.get(path)
+            if entry and entry[:2] == (stat.st_mtime, stat.st_size):
+                files[path] = entry
+            else:
+                changed.append((path, stat.st_mtime, stat.st_size, keys))
+
+    workers = min(len(changed) // PKGINFO_CHUNK_SIZE + 1,
+                  multiprocessing.cpu_count())
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            read = pool.map_async(_read_pkginfo, changed,
+                                  PKGINFO_CHUNK_SIZE).get(sys.maxint)
+        finally:
+            pool.terminate()
+    else:
+        read = [_read_pkginfo(job) for job in changed]
+    for job, entry in zip(changed, read):
+        files[job[0]] = entry
+
+    if use_cache and (changed or len(files) != len(cached_files)):
+        write_cache(cache_name, {"keys": keys, "files": files})
+
+    positions = {key: position for position, key in enumerate(keys)}
+    indexes = []
+    for catalog in catalogs:
+        indexes.append(CatalogIndex(
+            CatalogItem(positions, values) for _, _, item_catalogs, values in
+            files.values() if item_catalogs and catalog in item_catalogs))
+    return indexes[0] if len(indexes) == 1 else CatalogIndex.merge(indexes)
+
+
+def _read_pkginfo(job):
+    """Return (mtime, size, catalogs, values) for a pkginfo file.
+
+    Args:
+        job (tuple): (path, mtime, size, keys) of the file to read.
+
+    Returns:
+        tuple, with None for catalogs and values if the file isn't a
+        valid pkginfo.
+    """
+    path, mtime, size, keys = job
+    try:
+        pkginfo = FoundationPlist.readPlist(path)
+    except FoundationPlist.FoundationPlistException:
+        return (mtime, size, None, None)
+    if not hasattr(pkginfo, "get") or not pkginfo.get("name"):
+        return (mtime, size, None, None)
+    catalogs = tuple(intern(str(catalog)) for catalog in
+                     pkginfo.get("catalogs") or ())
+    return (mtime, size, catalogs, get_record_values(pkginfo, keys))
+
+
+def get_recipe_list_path(recipe_list_path):
+    """Return recipe_list_path, or AutoPkgr's recipe list if it's unset."""
     autopkgr_path = os.path.expanduser(
         "~/Library/Application Support/AutoPkgr/recipe_list.txt")
-    recipe_list_path = recipe_list_path if recipe_list_path else autopkgr_path
+    return recipe_list_path if recipe_list_path else autopkgr_path
+
+
+def get_recipes(recipe_list_path):
+    """Return a list of recipes read from a recipe list."""
+    recipe_list_path = get_recipe_list_path(recipe_list_path)
     if not os.path.exists(recipe_list_path):
         sys.exit("recipe_list file %s does not exist!" % recipe_list_path)
     with open(recipe_list_path) as recipe_list:
@@ -297,58 +2916,427 @@ def get_recipes(recipe_list_path):
     return recipes
 
 
+def get_exclusion_reason(recipe, recipe_index=None):
+    """Return why a recipe should not be overridden, or None."""
+    if recipe in RECIPE_EXCLUSIONS:
+        return ("Not overriding %s because it is in the list of "
+                "exclusions." % recipe)
+    if recipe.startswith("local"):
+        return "Not overriding %s because it _is_ an override." % recipe
+    if recipe_index is not None and recipe not in recipe_index:
+        return ("Not overriding %s because its recipe file can't be found "
+                "in the autopkg recipe search dirs." % recipe)
+    return None
+
+
+def get_unresolved_recipes(recipes, recipe_index):
+    """Return the set of recipes recipe_index can't find."""
+    if recipe_index is None:
+        return set()
+    return {recipe for recipe in recipes if
+            recipe not in RECIPE_EXCLUSIONS and
+            not recipe.startswith("local") and recipe not in recipe_index}
+
+
+def get_shard(recipes, shard, recipe_index=None):
+    """Return the recipes one of several sharded runs should process.
+
+    Recipes are de-duplicated, then partitioned by a hash of their
+    name, so every machine agrees on the partition. Excluded recipes
+    (see get_exclusion_reason) are left out of the partition, and only
+    reported by the first shard.
+
+    Args:
+        recipes (list of str): All the recipes.
+        shard (tuple): (index, count) of this shard, from 1.
+        recipe_index (RecipeIndex): For exclusions.
+
+    Returns:
+        list of str, in their original order.
+    """
+    index, count = shard
+    return [recipe for recipe in collections.OrderedDict.fromkeys(recipes) if
+            (index == 1 if get_exclusion_reason(recipe, recipe_index) else
+             get_shard_number(recipe, count) == index)]
+
+
+def get_shard_number(recipe, count):
+    return int(hashlib.sha1(recipe).hexdigest(), 16) % count + 1
+
+
+def get_catalog_names(recipes, args, recipe_index, answers=None):
+    """Return the product names a sharded run needs from the catalog.
+
+    These are the names in the recipes' (merged) Input, and in any name
+    answers. get_production_cat keeps the whole catalog if any of them
+    isn't in it.
+
+    Returns:
+        set of str, or None, to keep the whole catalog, if the run
+        isn't sharded, may prompt for a name (which could be any name),
+        or any recipe's name can't be found locally.
+    """
+    if not args.shard or not args.no_prompt:
+        return None
+    names = set(recipe_answers["name"] for recipe_answers in
+                (answers or {}).values() if recipe_answers.get("name"))
+    for recipe in recipes:
+        if get_exclusion_reason(recipe, recipe_index):
+            continue
+        chain = load_recipe_chain(recipe_index.resolve(recipe), recipe_index)
+        name = chain and get_name_from_override(
+            {"Input_Original": get_chain_input(chain)})
+        if not name:
+            return None
+        names.add(name)
+    return names
+
+
+def make_overrides(recipes, override_dir, jobs=1, recipe_index=None,
+                   existing=None):
+    """Make overrides, yielding the results in order.
+
+    With more than one job, autopkg runs for up to `jobs` recipes at
+    once, from a CommandRunner in a background thread. Results are
+    still yielded in the order of `recipes`, so output stays grouped by
+    recipe and all catalog work and plist writing happens, in order, in
+    the caller's thread.
+
+    Args:
+        recipes (list of str): Recipe names/ids to override.
+        override_dir (str): Path in which to create overrides.
+        jobs (int): Maximum number of concurrent autopkg processes.
+        recipe_index (RecipeIndex): If provided, overrides for recipes
+            that can be loaded from it are built in-process (see
+            make_override_in_process), and autopkg is only run for the
+            rest.
+        existing (dict): Recipe to the path of its existing override,
+            for recipes known to have one. These are reported as
+            'exists' without running autopkg.
+
+    Yields:
+        tuple of (str status, str override path or None, override dict
+        or None, list of log entries). Status is as returned by
+        make_override. The override dict is None when the override was
+        written to disk by autopkg.
+    """
+    built = []
+    planned_paths = set()
+    existing = existing or {}
+    if recipe_index is not None:
+        # autopkg make-override creates the override dir; so must we.
+        directory = os.path.realpath(os.path.expanduser(override_dir))
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as error:
+                print_error("Unable to create %s: %s" % (directory, error))
+    for recipe in recipes:
+        result = None
+        if recipe in existing:
+            result = ("exists", existing[recipe], None, [
+                ("Making override for %s" % recipe, False),
+                ("\tAn override plist already exists at %s, will not "
+                 "overwrite it." % existing[recipe], True)])
+        elif recipe_index is not None:
+            result = make_override_in_process(
+                recipe, override_dir, recipe_index, planned_paths)
+        built.append(result)
+
+    fallback = [recipe for recipe, result in zip(recipes, built) if
+                result is None]
+    made = iter_make_override_results(fallback, override_dir, jobs)
+    for result in built:
+        if result is None:
+            status, override_path, log = next(made)
+            result = (status, override_path, None, log)
+        yield result
+
+
+def iter_make_override_results(recipes, override_dir, jobs=1):
+    """Run make_override for recipes, yielding the results in order.
+
+    Yields:
+        tuple of (str status, str override path or None, list of log
+        entries), as returned by make_override.
+    """
+    if jobs <= 1:
+        for recipe in recipes:
+            yield make_override(recipe, override_dir)
+        return
+
+    commands = [get_make_override_command(recipe, override_dir)
+                for recipe in recipes]
+    runner = CommandRunner(commands, jobs)
+    results = Queue.Queue()
+
+    def run():
+        try:
+            for command in runner.run():
+                results.put(command)
+        except Exception as error:  # pylint: disable=broad-except
+            results.put(error)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    try:
+        for recipe in recipes:
+            # A timeout keeps the wait interruptible by Ctrl-C.
+            command = results.get(timeout=sys.maxint)
+            if isinstance(command, Exception):
+                raise command
+            yield get_make_override_result(recipe, command)
+    finally:
+        runner.stop()
+
+
 def make_override(recipe, override_dir):
     """Make an override and return its path.
 
+    Output is collected rather than printed, so overrides can be made
+    concurrently; use print_log to display it.
+
     Args:
         recipe (str): Recipe name.
         override_dir (str): Path in which to create overrides.
 
     Returns:
-        str path to new override, or None for errors or pre-existing
-        overrides.
+        tuple of (str status, str override path or None, list of (str
+        message, bool is_error) log entries). Status is 'created',
+        'exists' (the path is that of the existing override), 'missing'
+        (autopkg asked to search for the recipe), 'timeout' or
+        'failed'.
+    """
+    command = get_make_override_command(recipe, override_dir)
+    for _ in CommandRunner([command]).run():
+        pass
+    return get_make_override_result(recipe, command)
+
+
+def make_override_in_process(recipe, override_dir, recipe_index,
+                             planned_paths=None):
+    """Build an override like autopkg make-override, without writing it.
+
+    The override's Input is the recipe's Input, merged with the Input of
+    its parent recipes, as autopkg does it.
+
+    Args:
+        recipe (str): Recipe name.
+        override_dir (str): Path in which overrides are created.
+        recipe_index (RecipeIndex): Index to load recipes from.
+        planned_paths (set of str): Paths of overrides already built by
+            this run (but not yet written); updated with this override.
+
+    Returns:
+        tuple of (str status, str override path, override dict or None,
+        list of (str message, bool is_error) log entries), like
+        make_overrides, or None if the recipe can't be loaded locally.
+    """
+    recipe_path = recipe_index.resolve(recipe)
+    chain = load_recipe_chain(recipe_path, recipe_index)
+    if not chain:
+        return None
+    recipe_name = os.path.basename(recipe_path)
+    recipe_name = recipe_name[:-len(get_recipe_extension(recipe_name))]
+
+    log = [("Making override for %s" % recipe, False)]
+    override_path = os.path.join(
+        os.path.realpath(os.path.expanduser(override_dir)),
+        recipe_name + ".recipe")
+    if planned_paths is None:
+        planned_paths = set()
+    if os.path.exists(override_path) or override_path in planned_paths:
+        log.append(("\tAn override plist already exists at %s, will not "
+                    "overwrite it." % override_path, True))
+        return "exists", override_path, None, log
+    planned_paths.add(override_path)
+
+    override_input = get_chain_input(chain)
+    # autopkg names overrides like 'local.munki.Firefox' for a recipe
+    # file named 'Firefox.munki.recipe'.
+    name, _, recipe_type = recipe_name.rpartition(".")
+    identifier = ("local.%s.%s" % (recipe_type, name) if name else
+                  "local.%s" % recipe_name)
+    override = {"Identifier": identifier,
+                "Input": override_input,
+                "ParentRecipe": chain[0]["Identifier"]}
+    log.append(("Override built for %s" % override_path, False))
+    return "created", override_path, override, log
+
+
+def get_chain_input(chain):
+    """Return a recipe chain's Input, merged as autopkg does it."""
+    chain_input = {}
+    for parent in reversed(chain):
+        chain_input.update(parent.get("Input", {}))
+    return chain_input
+
+
+def load_recipe_chain(recipe_path, recipe_index):
+    """Load a recipe and its ancestors, or return None if any can't be.
+
+    Returns:
+        list of recipe dicts, starting with the recipe itself.
     """
-    print "Making override for %s" % recipe
-    command = ["/usr/local/bin/autopkg", "make-override", recipe]
+    chain = []
+    seen = set()
+    while recipe_path:
+        if (recipe_path in seen or
+                not recipe_path.endswith((".recipe", ".recipe.plist"))):
+            return None
+        seen.add(recipe_path)
+        try:
+            recipe = FoundationPlist.readPlist(recipe_path)
+        except FoundationPlist.FoundationPlistException:
+            return None
+        if not hasattr(recipe, "get") or not recipe.get("Identifier"):
+            return None
+        chain.append(recipe)
+        parent = recipe.get("ParentRecipe")
+        recipe_path = recipe_index.resolve(parent) if parent else None
+        if parent and not recipe_path:
+            return None
+    return chain or None
+
+
+def get_make_override_command(recipe, override_dir):
+    """Return a Command to run autopkg make-override for a recipe."""
+    args = [AUTOPKG, "make-override", recipe]
     if override_dir:
-        command.insert(2, "--override-dir=%s" %
-                        os.path.realpath(override_dir))
+        args.insert(2, "--override-dir=%s" % os.path.realpath(override_dir))
     # autopkg will offer to search for missing recipes, and wait for
-    # input. Therefore, we use a short timeout to just skip any
-    # recipes that are (probably) hung up on the prompt.
-    proc = Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE)
-    try:
-        output, error = proc.communicate(timeout=3)
-    except TimeoutError:
-        print_error(
-            "\tPlease ensure you have the recipe file for %s." % recipe)
-        return None
+    # input. Kill it as soon as it asks, or, in case the prompt
+    # changes, after a short period of inactivity.
+    return Command(args, timeout=AUTOPKG_TIMEOUT, prompts=AUTOPKG_PROMPTS)
 
-    failure_string = "An override plist already exists at"
-    if failure_string in error:
-        print_error("\t" + error.strip())
-        return None
 
-    return output[output.find("/"):].strip()
+def get_make_override_result(recipe, command):
+    """Interpret a finished make-override Command.
+
+    Returns:
+        tuple of (str status, str override path or None, list of log
+        entries), as returned by make_override.
+    """
+    log = [("Making override for %s" % recipe, False)]
+    if command.timed_out or command.prompted:
+        log.append(("\tPlease ensure you have the recipe file for %s." %
+                    recipe, True))
+        return "timeout" if command.timed_out else "missing", None, log
+
+    error = command.stderr
+    exists = OVERRIDE_EXISTS_RE.search(error)
+    if exists:
+        log.append(("\t" + error.strip(), True))
+        return "exists", exists.group(1), log
 
+    output = command.stdout
+    if command.returncode != 0 or "/" not in output:
+        log.append(("\tautopkg failed to make an override for %s: %s" %
+                    (recipe, error.strip() or output.strip()), True))
+        return "failed", None, log
 
-def get_current_production_version(production_cat, override, args):
-    # current_version = None
+    return "created", output[output.find("/"):].strip(), log
+
+
+def get_current_production_version(production_cat, override, args,
+                                   answers=None, questions=None):
+    """Return the newest catalog pkginfo for an override's product.
+
+    If the product name can't be found, and prompting is allowed, a
+    name answer is used if there is one; otherwise a question asking
+    for it, with the closest catalog names as suggestions, is added to
+    questions. Without prompting, the closest name is used if it
+    scores at least args.match_threshold.
+
+    Args:
+        production_cat (CatalogIndex): Catalog to look up.
+        override (Plist): Override plist object.
+        args: ArgumentParser args with no_prompt and match_threshold.
+        answers (dict): Answers to this recipe's questions.
+        questions (list): Unanswered questions are appended here.
+
+    Returns:
+        The pkginfo, or an empty dict.
+    """
+    answers = answers if answers is not None else {}
     name = get_name_from_override(override)
     current_version = get_current_production_version_from_name(
         name, production_cat)
-    if not current_version and not args.no_prompt:
-        print_error("\tUnable to determine product 'name'.")
-        while not current_version:
-            choice = raw_input("\tPlease enter a Munki name for the product, "
-                               "or hit enter to skip lookup: ")
-            if not choice:
-                return {}
-            current_version = get_current_production_version_from_name(
-                choice, production_cat)
+    if current_version:
+        return current_version
+    hint = get_name_hint(override)
+    if args.no_prompt and "name" not in answers:
+        return get_closest_production_version(hint, production_cat,
+                                              args.match_threshold)
+
+    choice = answers.get("name")
+    if choice == "":
+        return {}
+    elif choice is not None:
+        current_version = get_current_production_version_from_name(
+            choice, production_cat)
+        if current_version or args.no_prompt:
+            return current_version
+        print_error("\tNo product named '%s' found." % choice)
+        hint = choice
+
+    if questions is not None:
+        suggestions = [name for _, name in production_cat.suggest(hint)]
+        prompt = "\tUnable to determine product 'name'.\n"
+        if suggestions:
+            prompt += "\tClosest catalog names: %s\n" % ", ".join(
+                "%d) %s" % (number, name) for number, name in
+                enumerate(suggestions, 1))
+        prompt += ("\tPlease enter a Munki name for the product%s, or hit "
+                   "enter to skip lookup: " % (
+                       ", or the number of a suggestion" if suggestions else
+                       ""))
+        questions.append(("name", suggestions, prompt))
+    return {}
+
+
+def get_closest_production_version(hint, production_cat, threshold):
+    """Return the newest pkginfo of the name closest to hint.
+
+    Returns:
+        The pkginfo, or an empty dict if no name scores at least
+        threshold.
+    """
+    suggestions = production_cat.suggest(hint, 1) if hint else []
+    if not suggestions or suggestions[0][0] < threshold:
+        return {}
+    score, name = suggestions[0]
+    print "\tUsing closest catalog name '%s' for '%s' (score %.2f)." % (
+        name, hint, score)
+    return get_current_production_version_from_name(name, production_cat)
+
+
+def get_name_hint(override):
+    """Return a name to base suggestions on for an unresolved override.
+
+    This is the override's name, or failing that, the last part of its
+    parent recipe's identifier, e.g. 'Firefox' for
+    'com.github.autopkg.munki.Firefox'.
+    """
+    name = get_name_from_override(override)
+    if name:
+        return name
+    parts = [part for part in override.get("ParentRecipe", "").split(".") if
+             part.lower() not in ("munki", "")]
+    return parts[-1] if parts else None
+
 
-    return current_version
+def get_product_name(override, production_cat, answers=None):
+    """Return the name an override's product is looked up by.
+
+    This is for when no catalog item was found; otherwise the name of
+    the item used is more accurate (e.g. for fuzzy matches).
+    """
+    name = get_name_from_override(override)
+    if name not in production_cat and (answers or {}).get("name"):
+        name = answers["name"]
+    return name
 
 
 def get_name_from_override(override):
@@ -361,12 +3349,12 @@ def get_name_from_override(override):
 
 
 def get_current_production_version_from_name(input_name, production_cat):
-    pkginfos = [item for item in production_cat if item["name"] == input_name]
-    return (max(pkginfos, key=lambda x: LooseVersion(x["version"])) if pkginfos
-            else {})
+    return production_cat.get_newest(input_name)
 
 
-def apply_current_or_orig_values(override, current_version, args):
+def apply_current_or_orig_values(override, current_version, args,
+                                 previous_input=None, answers=None,
+                                 questions=None):
     """Get important metadata from current or original recipe.
 
     Args:
@@ -375,7 +3363,16 @@ def apply_current_or_orig_values(override, current_version, args):
         args: ArgumentParser args with args:
             no_prompt (bool): Whether to get interactive values.
             keys (tuple/list): Metadata keys to consider.
+        previous_input (dict): When refreshing an override, its
+            previous 'Input'. Its values are kept, without prompting,
+            for keys with no current value.
+        answers (dict): Answers to this recipe's questions.
+        questions (list): Questions for keys with no value, and no
+            answer, are appended here. Meanwhile, the recipe value is
+            used.
     """
+    previous_pkginfo = (previous_input or {}).get("pkginfo") or {}
+    key_answers = (answers or {}).get("keys") or {}
     keys = args.keys
     if current_version:
         print "\tUsing metadata values from {} version {}.".format(
@@ -384,20 +3381,33 @@ def apply_current_or_orig_values(override, current_version, args):
         current_val = current_version.get(key)
         if current_val:
             override["Input"]["pkginfo"][key] = current_val
+        elif previous_pkginfo.get(key):
+            override["Input"]["pkginfo"][key] = previous_pkginfo[key]
         else:
             default = override["Input_Original"].get(
                 "pkginfo", {}).get(key, "")
-            choice = ""
-            if not args.no_prompt:
-                print "\tNo current '%s' value found to apply." % key
-                print "\tRecipe specifies: '%s'" % default
-                choice = raw_input("\tHit enter to use the recipe value, or "
-                                   "enter a new value: ")
+            choice = key_answers.get(key, "")
+            if (key not in key_answers and not args.no_prompt and
+                    questions is not None):
+                questions.append((
+                    "keys", key,
+                    "\tNo current '%s' value found to apply.\n"
+                    "\tRecipe specifies: '%s'\n"
+                    "\tHit enter to use the recipe value, or enter a new "
+                    "value: " % (key, default)))
             override["Input"]["pkginfo"][key] = (
                 default if choice == "" else choice)
 
 
-def copy_package_path_to_input(override, current_version, args):
+def copy_package_path_to_input(override, current_version, args, answers=None,
+                               questions=None):
+    """Set the override's MUNKI_REPO_SUBDIR from the current version.
+
+    With --specify_subdir and no value, the subdirectory is asked for:
+    a subdir answer is used if there is one; otherwise a question is
+    appended to questions, and the default is used meanwhile.
+    """
+    answers = answers if answers is not None else {}
     pkg_path = "installer_item_location"
     munki_subdir = "MUNKI_REPO_SUBDIR"
     # Make sure we can even override the subdirectory.
@@ -405,9 +3415,13 @@ def copy_package_path_to_input(override, current_version, args):
     if pkg_path in current_version and munki_subdir in override["Input_Original"]:
         default = os.path.dirname(current_version.get(pkg_path))
         if args.specify_subdir == "<PROMPT>":
-            choice = raw_input(
-                "\tPlease enter a subdirectory to import pkginfo and pkg to "
-                "(Hit enter to accept default value '%s'): " % default)
+            choice = answers.get("subdir")
+            if choice is None and questions is not None:
+                questions.append((
+                    "subdir", None,
+                    "\tPlease enter a subdirectory to import pkginfo and "
+                    "pkg to (Hit enter to accept default value '%s'): " %
+                    default))
             subdirectory = default if not choice else choice
         elif args.specify_subdir:
             subdirectory = override["Input"]["pkginfo"].get(
@@ -421,24 +3435,41 @@ def copy_package_path_to_input(override, current_version, args):
         print "\tCan't override %s" % munki_subdir
 
 
-def apply_pkginfo_template(override, pkginfo_template):
-    """Force values from pkginfo_template on override's pkginfo."""
+def apply_pkginfo_template(override, pkginfo_template, recipe=None):
+    """Force values from pkginfo_template on override's pkginfo.
+
+    Args:
+        override (Plist): Override with its 'Input' pkginfo set.
+        pkginfo_template (PkginfoTemplate or dict): Values to enforce.
+        recipe (str): Recipe name, for 'recipe' rule conditions.
+    """
+    if isinstance(pkginfo_template, PkginfoTemplate):
+        fields = dict(override["Input"]["pkginfo"])
+        fields["recipe"] = recipe
+        fields["parent_recipe"] = override.get("ParentRecipe")
+        pkginfo_template = pkginfo_template.get_values(fields)
     # Need to "convert" Objc object to dict.
     override["Input"]["pkginfo"].update(dict(pkginfo_template))
     print "\tApplied pkginfo template."
 
 
-def set_file_nonblock(f, non_blocking=True):
-    """Set non-blocking flag on a file object.
+def write_profile(profiler, path):
+    """Save profiler's stats to path, or print a summary if path is '-'."""
+    import pstats
+    if path == "-":
+        profile_stats = pstats.Stats(profiler, stream=sys.stderr)
+        profile_stats.sort_stats("cumulative").print_stats(PROFILE_LINES)
+    else:
+        profiler.dump_stats(path)
 
-    Args:
-      f: file
-      non_blocking: bool, default True, non-blocking mode or not
-    """
-    flags = fcntl.fcntl(f.fileno(), fcntl.F_GETFL)
-    if bool(flags & os.O_NONBLOCK) != non_blocking:
-        flags ^= os.O_NONBLOCK
-    fcntl.fcntl(f.fileno(), fcntl.F_SETFL, flags)
+
+def print_log(log):
+    """Print (message, is_error) log entries."""
+    for message, is_error in log:
+        if is_error:
+            print_error(message)
+        else:
+            print message
 
 
 def print_error(message):